@@ -9,18 +9,19 @@ import os
 import sys
 import json
 import argparse
-from angstrom import Molecule
+from nanocar_worker import request
+from instrumentation import stage, run, dumps, debug_modes
 
 
 # Some globals:
 debug = True
 
 chassis_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'chassis')
-chassis_list = [i.split('.')[0] for i in os.listdir(chassis_dir)]
 
 
 def get_options():
     """Create user interface options."""
+    chassis_list = sorted(os.path.splitext(i)[0] for i in os.listdir(chassis_dir) if i.endswith('.xyz'))
     user_options = {}
     user_options['chassis'] = {'label': 'Chassis',
                                'type': 'stringList',
@@ -50,28 +51,37 @@ def get_options():
 
 def build_nanocar(opts):
     """Builds Nanocar molecule."""
-    chassis = Molecule(read=os.path.join(chassis_dir, '%s.xyz' % opts['chassis']))
-    chassis.center([opts['center-x'], opts['center-y'], opts['center-z']])
-    return mol2xyz(chassis)
-
-
-def mol2xyz(mol):
-    """Converts Angstrom Molecule to xyz string"""
-    mol_xyz = "%i\n%s\n" % (len(mol.atoms), mol.name)
-    for atom, coor in zip(mol.atoms, mol.coordinates):
-        mol_xyz += "%s %f %f %f\n" % (atom, coor[0], coor[1], coor[2])
-    return mol_xyz
-
-
-def run_command():
+    from angstrom import Molecule
+    from molecule_library import load_library, get_molecule
+    from molecule_writer import cjson_dict
+    with stage('load_chassis'):
+        entry = get_molecule(load_library(chassis_dir), opts['chassis'])
+    with stage('center', atoms=len(entry['numbers'])):
+        chassis = Molecule(atoms=entry['atoms'], coordinates=entry['coordinates'])
+        chassis.name = opts['chassis']
+        chassis.center([opts['center-x'], opts['center-y'], opts['center-z']])
+    with stage('cjson', atoms=len(entry['numbers'])):
+        return cjson_dict(entry['numbers'], chassis.coordinates, entry['bonds'], name=chassis.name)
+
+
+def run_command(stdinStr=None):
     """Run main function - add wheel."""
-    stdinStr = sys.stdin.read()
-    opts = json.loads(stdinStr)
+    if stdinStr is None:
+        stdinStr = sys.stdin.read()
+    from cjson_io import loads
+    with stage('parse_input', nbytes=len(stdinStr)):
+        opts = loads(stdinStr)
 
     result = {}
     result['append'] = True
-    result['moleculeFormat'] = 'xyz'
-    result['xyz'] = build_nanocar(opts)
+    result['moleculeFormat'] = 'cjson'
+    result['cjson'] = build_nanocar(opts)
+    # Keep track of the chassis atoms in the document
+    from scene_state import record_components, document_numbers
+    numbers = result['cjson']['atoms']['elements']['number']
+    with stage('record_scene'):
+        record_components(document_numbers(opts), numbers,
+                          [{'kind': 'chassis', 'name': opts['chassis'], 'id': [1, len(numbers)]}])
     return result
 
 
@@ -85,13 +95,18 @@ if __name__ == "__main__":
     parser.add_argument('--lang', nargs='?', default='en')
     args = vars(parser.parse_args())
 
-    debug = args['debug']
+    debug = debug_modes(args['debug'])
 
     if args['display_name']:
         print("Add Chassis")
     if args['menu_path']:
         print("&Build|Nanocar")
     if args['print_options']:
-        print(json.dumps(get_options()))
+        reply = request('add_chassis', 'print_options')
+        print(reply if reply is not None else json.dumps(get_options()))
     elif args['run_command']:
-        print(json.dumps(run_command()))
+        stdinStr = sys.stdin.read()
+        reply = request('add_chassis', 'run_command', stdinStr, debug=debug)
+        if reply is None:
+            reply = run('add_chassis', 'run_command', lambda: dumps(run_command(stdinStr)), modes=debug)
+        print(reply)
@@ -0,0 +1,204 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+                            o---o NANOCAR o---o
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Headless batch builder for nanocar libraries.
+Builds every chassis x wheel x surface combination in a spec file with the plug-in
+functions (build_nanocar, connect_wheel, build_slab, setup_lammps) over a process pool
+and writes one LAMMPS run directory per combination.
+
+Usage:
+ >>> python batch_builder.py spec.json --processes 8
+
+Example spec (JSON, or YAML if PyYAML is installed):
+{
+    "output": "nanocar-runs",
+    "chassis": ["chassis-H2-cd"],
+    "wheels": "all",
+    "sites": {"chassis-H2-cd": [80, 81, 84, 85]},
+    "surfaces": [{"surface": "fcc111", "metal": "Au", "a": 4.08, "size": [20, 20, 4], "vacuum": 10.0}],
+    "bond_distance": 1.5,
+    "gap": 3.0,
+    "spin": 36,
+    "min_clearance": 2.0,
+    "lammps": {"box_z": 3.0, "timestep": 1.0, "sim_length": 1.0}
+}
+`sites` lists the chassis atom indices (0-based, in the chassis xyz file) wheels are connected to.
+Systems whose wheels come closer than min_clearance (Å) to the chassis or each other are
+not written and recorded with status 'clash'.
+Progress is appended to <output>/manifest.jsonl, finished systems are skipped when the
+batch is run again so interrupted batches can be resumed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
+MANIFEST_FILE = 'manifest.jsonl'
+DEFAULT_LAMMPS = {'box_z': 3.0, 'timestep': 1.0, 'sim_length': 1.0}
+# Minimum wheel clearance (Å) of a usable system (as the Clash Distance of Connect Wheel)
+MIN_CLEARANCE = 2.0
+
+
+def read_spec(spec_file):
+    """Read batch spec from JSON or YAML file."""
+    with open(spec_file, 'r') as f:
+        if spec_file.endswith(('.yml', '.yaml')):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def expand_jobs(spec):
+    """Expand spec into a list of jobs, one per chassis x wheel x surface combination."""
+    chassis_dir, wheel_dir = os.path.join(PLUGIN_DIR, 'chassis'), os.path.join(PLUGIN_DIR, 'wheel')
+    chassis = spec['chassis'] if spec['chassis'] != 'all' else _molecule_names(chassis_dir)
+    wheels = spec['wheels'] if spec['wheels'] != 'all' else _molecule_names(wheel_dir)
+    lammps = dict(DEFAULT_LAMMPS, **spec.get('lammps', {}))
+    output = os.path.abspath(spec['output'])
+    for name in chassis:
+        if name not in spec['sites']:
+            raise ValueError('No wheel sites given for chassis %s' % name)
+
+    jobs = []
+    for name, wheel, surface in itertools.product(chassis, wheels, spec['surfaces']):
+        surface = dict({'a': None, 'vacuum': 10.0, 'orthogonal': True}, **surface)
+        job_id = '%s__%s__%s-%s' % (name, wheel, surface['surface'], surface['metal'])
+        jobs.append({'id': job_id, 'dir': os.path.join(output, job_id), 'chassis': name,
+                     'wheel': wheel, 'sites': spec['sites'][name], 'surface': surface,
+                     'd': spec.get('bond_distance', 1.5), 'spin': spec.get('spin', 0), 'gap': spec.get('gap', 3.0),
+                     'min_clearance': spec.get('min_clearance', MIN_CLEARANCE), 'lammps': lammps})
+    return jobs
+
+
+def build_system(job):
+    """Build a single nanocar on surface system and write its LAMMPS files."""
+    import numpy as np
+    from add_chassis import build_nanocar
+    from connect_wheel import connect_wheel, wheel_components, anchor_index
+    from surface_builder import build_slab
+    from lammps_setup import setup_lammps
+    from surface_placement import place_nanocars
+    from molecule_writer import xyz_string, cjson_dict
+    from elements import symbols
+
+    t0 = time.time()
+    os.makedirs(job['dir'], exist_ok=True)
+
+    # Nanocar: chassis with a wheel connected to each site
+    chassis = build_nanocar({'chassis': job['chassis'], 'center-x': 0.0, 'center-y': 0.0, 'center-z': 0.0})
+    n_chassis = len(chassis['atoms']['elements']['number'])
+    chassis['atoms']['selected'] = [idx in job['sites'] for idx in range(n_chassis)]
+    chassis.setdefault('bonds', {'connections': {'index': []}})
+    nanocar = connect_wheel({'cjson': chassis, 'wheel': job['wheel'], 'append': False, 'd': job['d'],
+                             'spin': job['spin'], 'clash': job['min_clearance']})
+    if nanocar is None:
+        raise ValueError('Could not connect %s to %s sites %s' % (job['wheel'], job['chassis'], job['sites']))
+    clearance = nanocar['properties']['wheelClearance']
+    if min(clearance) < job['min_clearance']:
+        return {'id': job['id'], 'status': 'clash', 'dir': job['dir'], 'wheel_clearance': clearance,
+                'error': 'Wheel clearance %.3f Å is below min_clearance (%.2f Å)'
+                         % (min(clearance), job['min_clearance']), 'time': time.time() - t0}
+
+    # Surface
+    surf = job['surface']
+    slab = build_slab(surf['surface'], surf['metal'], surf['a'], surf['size'], surf['vacuum'], surf['orthogonal'])
+
+    # Place the nanocar over the middle of the slab around `gap` above the top layer
+    car_numbers = np.array(nanocar['atoms']['elements']['number'])
+    car_coords = np.array(nanocar['atoms']['coords']['3d']).reshape(-1, 3)
+    (car_coords,), (energy,) = place_nanocars([(car_numbers, car_coords)], slab['numbers'], slab['positions'],
+                                              slab['cell'], gap=job['gap'])
+
+    numbers = np.concatenate([car_numbers, slab['numbers']])
+    coords = np.vstack([car_coords, slab['positions']])
+    n_car = len(car_coords)
+    system = cjson_dict(numbers, coords, np.array(nanocar['bonds']['connections']['index']).reshape(-1, 2))
+    with open(os.path.join(job['dir'], 'system.xyz'), 'w') as f:
+        f.write(xyz_string(symbols(numbers), coords, job['id']))
+
+    # Scene components are kept in memory, concurrent jobs do not share any state files
+    surface = {'kind': 'surface', 'name': '%s-%s' % (surf['surface'], surf['metal']),
+               'id': [n_car + 1, n_car + len(slab['numbers'])],
+               'x': float(slab['cell'][0][0]), 'y': float(slab['cell'][1][1])}
+    scene = ([{'kind': 'chassis', 'name': job['chassis'], 'id': [1, n_chassis]}]
+             + wheel_components(job['wheel'], sorted(job['sites']), (n_car - n_chassis) // len(job['sites']), n_chassis + 1,
+                                anchor=anchor_index(nanocar, n_chassis))
+             + [surface])
+    # Other LAMMPS setup options (e.g. ff, flexible) are passed through from the spec
+    opts = dict(job['lammps'], cjson=system, box_x=surface['x'] / 10, box_y=surface['y'] / 10, dir=job['dir'])
+    setup_lammps(opts, scene=scene)
+
+    return {'id': job['id'], 'status': 'done', 'dir': job['dir'], 'n_atoms': len(numbers),
+            'n_nanocar': n_car, 'n_surface': len(slab['numbers']),
+            'wheel_clearance': clearance, 'surface_energy': energy, 'time': time.time() - t0}
+
+
+def run_batch(spec, processes=None):
+    """Build all systems in a spec, skipping systems already finished in the manifest."""
+    jobs = expand_jobs(spec)
+    output = os.path.abspath(spec['output'])
+    os.makedirs(output, exist_ok=True)
+    manifest_file = os.path.join(output, MANIFEST_FILE)
+    finished = read_manifest(manifest_file)
+    todo = [job for job in jobs if job['id'] not in finished]
+    print('%i systems, %i already built, %i to build' % (len(jobs), len(jobs) - len(todo), len(todo)))
+
+    n_done, n_failed = 0, 0
+    with open(manifest_file, 'a') as manifest, ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(_build_safe, job): job for job in todo}
+        for future in as_completed(futures):
+            record = future.result()
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+            if record['status'] == 'done':
+                n_done += 1
+            else:
+                n_failed += 1
+                print('%s -> %s\n%s' % (record['status'].capitalize(), record['id'], record['error']))
+            print('[%i/%i] %s' % (n_done + n_failed, len(todo), record['id']))
+    print('Done! %i built, %i failed (or clashing).' % (n_done, n_failed))
+    return n_failed == 0
+
+
+def read_manifest(manifest_file):
+    """Ids of successfully built systems in manifest."""
+    finished = set()
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written line from an interrupted run
+                    continue
+                if record['status'] == 'done':
+                    finished.add(record['id'])
+    return finished
+
+
+def _build_safe(job):
+    try:
+        return build_system(job)
+    except Exception:
+        return {'id': job['id'], 'status': 'failed', 'dir': job['dir'], 'error': traceback.format_exc()}
+
+
+def _molecule_names(directory):
+    return sorted(os.path.splitext(i)[0] for i in os.listdir(directory) if i.endswith('.xyz'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build nanocar libraries from a combinatorial spec.')
+    parser.add_argument('spec', type=str, help='Batch spec file (JSON or YAML).')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs).')
+    args = vars(parser.parse_args())
+
+    sys.exit(0 if run_batch(read_spec(args['spec']), args['processes']) else 1)
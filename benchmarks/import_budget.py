@@ -0,0 +1,72 @@
+"""
+Import-time budget for plug-in metadata queries.
+Avogadro calls every plug-in script with --display-name, --menu-path and
+--print-options while building its menus. These only print static strings or
+option dicts, so they must not import heavy packages.
+
+Each query is run with `python -X importtime` (worker disabled) and fails if
+ - the total import time exceeds the budget, or
+ - any of the heavy packages (numpy, ase, angstrom, periodictable) is imported.
+
+Usage:
+ >>> python benchmarks/import_budget.py --budget 50
+Exits with status 1 if any query is over budget.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+
+NANOCAR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+ENTRY_POINTS = ['add_chassis.py', 'connect_wheel.py', 'surface_builder.py', 'lammps_setup.py']
+METADATA_FLAGS = ['--display-name', '--menu-path', '--print-options']
+HEAVY_PACKAGES = ['numpy', 'ase', 'angstrom', 'periodictable']
+
+
+def measure_imports(script, flag):
+    """Run a plug-in query with -X importtime and return {module: cumulative time (ms)} for top-level imports."""
+    env = dict(os.environ, NANOCAR_WORKER='0')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(NANOCAR_DIR, script), flag],
+                          env=env, cwd=NANOCAR_DIR, check=True, text=True,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented, only count top-level ones towards the total
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative) / 1000
+        else:
+            imports.setdefault(name.strip(), 0.0)
+    return imports
+
+
+def check_budget(budget):
+    """Check all entry point metadata queries, print a report and return True if all pass."""
+    print('%-20s %-16s %10s   %s' % ('Script', 'Query', 'Time (ms)', 'Status'))
+    print('-' * 70)
+    passed = True
+    for script in ENTRY_POINTS:
+        for flag in METADATA_FLAGS:
+            imports = measure_imports(script, flag)
+            total = sum(imports.values())
+            heavy = [pkg for pkg in HEAVY_PACKAGES if pkg in imports]
+            status = 'ok'
+            if heavy:
+                status = 'FAIL (imports %s)' % ', '.join(heavy)
+            elif total > budget:
+                status = 'FAIL (over %.1f ms)' % budget
+            passed = passed and status == 'ok'
+            print('%-20s %-16s %10.1f   %s' % (script, flag, total, status))
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import-time budget for plug-in metadata queries.')
+    parser.add_argument('--budget', '-b', type=float, default=50.0,
+                        help='Maximum total import time per query in ms (default: 50).')
+    args = vars(parser.parse_args())
+
+    sys.exit(0 if check_budget(args['budget']) else 1)
@@ -0,0 +1,305 @@
+"""
+End-to-end benchmark for the build and setup pipeline.
+Drives the plug-in functions the way the plug-in scripts do (build_nanocar, connect_wheel,
+build_surface, setup_lammps and the lammps_writer files) with synthetic systems from 10^2 to
+10^6 atoms: a grid chassis with C60 wheels along its edges on an Au(111) slab.
+Each system size runs in a fresh interpreter and the wall time and peak RSS after every stage
+are recorded. Results are appended to a history file (one JSON record per run, tagged with the
+git commit) and two commits can be compared to flag regressions. Commits without a record in
+the history are benchmarked in a temporary git worktree. Only local data is used.
+
+Usage:
+ >>> python benchmarks/pipeline.py --sizes 100 10000 1000000
+ >>> python benchmarks/pipeline.py --compare HEAD~1 HEAD --threshold 0.2
+Exits with status 1 if a stage failed or (in comparison mode) regressed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+import subprocess
+
+
+NANOCAR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HISTORY_FILE = os.path.join(NANOCAR_DIR, 'benchmarks', 'pipeline_history.jsonl')
+SIZES = [100, 1000, 10000, 100000, 1000000]
+# Stage time differences below this (s) are not flagged as regressions
+MIN_DIFFERENCE = 0.01
+BOND_LENGTH = 1.4
+WHEEL_SPACING = 10.0
+
+
+def system_plan(n_atoms):
+    """
+    Synthetic system with about n_atoms atoms: chassis grid (nx x ny, 5 % of the atoms),
+    C60 wheels along the two long chassis edges and a 4 layer Au(111) slab for the rest.
+    """
+    import numpy as np
+    n_chassis = max(16, n_atoms // 20)
+    nx = int(np.ceil(np.sqrt(n_chassis)))
+    ny = max(2, n_chassis // nx)
+    n_sites = max(2, min(2 * int(nx * BOND_LENGTH / WHEEL_SPACING), n_atoms // 1000))
+    n_surface = max(n_atoms - nx * ny - 60 * n_sites, 16)
+    # Orthogonal fcc(111) cells need an even number of rows
+    side = max(2, 2 * int(np.sqrt(n_surface / 4) / 2))
+    return {'nx': nx, 'ny': ny, 'n_sites': n_sites, 'surface_size': [side, side, 4]}
+
+
+def synthetic_chassis(nx, ny, n_sites):
+    """Chassis cjson: carbon grid with bonds to grid neighbors and wheel sites selected on two edges."""
+    import numpy as np
+    i, j = np.meshgrid(np.arange(nx), np.arange(ny), indexing='xy')
+    coords = np.column_stack([i.ravel(), j.ravel(), np.zeros(i.size)]) * BOND_LENGTH
+    index = np.arange(nx * ny).reshape(ny, nx)
+    bonds = np.vstack([np.column_stack([index[:, :-1].ravel(), index[:, 1:].ravel()]),
+                       np.column_stack([index[:-1].ravel(), index[1:].ravel()])])
+    bottom, top = (n_sites + 1) // 2, n_sites // 2
+    sites = np.concatenate([index[0, np.linspace(0, nx - 1, bottom).round().astype(int)],
+                            index[-1, np.linspace(0, nx - 1, top).round().astype(int)]])
+    selected = np.zeros(nx * ny, dtype=bool)
+    selected[sites] = True
+    return {'atoms': {'coords': {'3d': coords.ravel().tolist()},
+                      'elements': {'number': [6] * (nx * ny)},
+                      'selected': selected.tolist()},
+            'bonds': {'connections': {'index': bonds.ravel().tolist()}, 'order': [1] * len(bonds)}}
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB."""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+def run_stages(n_atoms, root=NANOCAR_DIR):
+    """Run all pipeline stages for one system size (in this process) and return their timings."""
+    workdir = tempfile.mkdtemp(prefix='nanocar-bench-')
+    # Cold slab builds and no resident worker
+    os.environ['NANOCAR_SLAB_CACHE'] = os.path.join(workdir, 'slab_cache')
+    os.environ['NANOCAR_WORKER'] = '0'
+    sys.path.insert(0, root)
+    stages = {}
+
+    def timed(name, func, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            stages[name] = {'status': 'error', 'error': '%s: %s' % (type(error).__name__, error)}
+            raise
+        stages[name] = {'status': 'ok', 'time': time.perf_counter() - t0, 'rss': peak_rss()}
+        return result
+
+    try:
+        import numpy as np
+        plan = system_plan(n_atoms)
+        t0 = time.perf_counter()
+        imports = {}
+        exec('from add_chassis import build_nanocar\n'
+             'from connect_wheel import connect_wheel\n'
+             'from surface_builder import build_surface\n'
+             'from lammps_setup import setup_lammps\n'
+             'from lammps_writer import write_data_file, write_input_file', imports)
+        stages['import'] = {'status': 'ok', 'time': time.perf_counter() - t0, 'rss': peak_rss()}
+
+        timed('build_nanocar', imports['build_nanocar'],
+              {'chassis': 'chassis-H2-cd', 'center-x': 0.0, 'center-y': 0.0, 'center-z': 0.0})
+        chassis = synthetic_chassis(plan['nx'], plan['ny'], plan['n_sites'])
+        nanocar = timed('connect_wheel', imports['connect_wheel'],
+                        {'cjson': chassis, 'wheel': 'C60', 'append': False, 'd': 1.5})
+        size = plan['surface_size']
+        surface = timed('build_surface', imports['build_surface'],
+                        {'surface': 'fcc111', 'metal': 'Au', 'a': 4.08, 'size-x': size[0], 'size-y': size[1],
+                         'size-z': size[2], 'vacuum': 10.0, 'orthogonal': 'True'})
+
+        # Document sent by Avogadro: nanocar followed by the surface, as JSON text
+        n_car, n_chassis = len(nanocar['atoms']['elements']['number']), plan['nx'] * plan['ny']
+        n_surface = len(surface['atoms']['elements']['number'])
+        system = {'atoms': {'coords': {'3d': nanocar['atoms']['coords']['3d'] + surface['atoms']['coords']['3d']},
+                            'elements': {'number': nanocar['atoms']['elements']['number']
+                                         + surface['atoms']['elements']['number']}},
+                  'bonds': nanocar['bonds']}
+        payload = json.dumps({'cjson': system})
+        try:
+            from cjson_io import loads
+        except ImportError:
+            # Commits before the cjson reader
+            loads = json.loads
+        system = timed('read_cjson', loads, payload)['cjson']
+        n_wheel = (n_car - n_chassis) // plan['n_sites']
+        cell = surface['unitCell']['cellVectors']
+        scene = ([{'kind': 'chassis', 'name': 'grid', 'id': [1, n_chassis]}]
+                 + [{'kind': 'wheel', 'name': 'C60', 'id': [n_chassis + k * n_wheel + 1, n_chassis + (k + 1) * n_wheel]}
+                    for k in range(plan['n_sites'])]
+                 + [{'kind': 'surface', 'name': 'fcc111-Au', 'id': [n_car + 1, n_car + n_surface],
+                     'x': cell[0], 'y': cell[4]}])
+        opts = {'cjson': system, 'box_x': cell[0] / 10, 'box_y': cell[4] / 10, 'box_z': 3.0, 'timestep': 1.0,
+                'sim_length': 1.0, 'dir': workdir, 'place': True}
+        timed('setup_lammps', imports['setup_lammps'], opts, scene=scene)
+
+        # lammps_writer on its own for the placed system
+        from angstrom import Molecule
+        numbers = system['atoms']['elements']['number']
+        try:
+            from elements import symbols
+        except ImportError:
+            # Commits before the element table
+            import periodictable
+            def symbols(numbers):
+                return [periodictable.elements[z].symbol for z in numbers]
+        molecule = Molecule(atoms=symbols(numbers),
+                            coordinates=np.array(system['atoms']['coords']['3d']).reshape(-1, 3))
+        molecule.set_cell([cell[0], cell[4], 30.0, 90, 90, 90])
+        timed('write_data_file', imports['write_data_file'], os.path.join(workdir, 'data.bench'), molecule)
+        timed('write_input_file', imports['write_input_file'], os.path.join(workdir, 'in.bench'), molecule,
+              {'sim_length': 1.0, 'ts': 1.0, 'T': 300, 'groups': {'mol': [[1, n_car]],
+                                                                   'surf': [[n_car + 1, n_car + n_surface]]}})
+        n_atoms = len(numbers)
+    except Exception:
+        if all(stage['status'] == 'ok' for stage in stages.values()):
+            stages['run'] = {'status': 'error', 'error': traceback.format_exc()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'n_atoms': n_atoms, 'stages': stages, 'peak_rss': peak_rss()}
+
+
+def run_size(n_atoms, root=NANOCAR_DIR, repeat=1):
+    """Benchmark one system size in fresh interpreters, keeping the fastest time of each stage."""
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', str(n_atoms), '--root', root],
+                              cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            return {'n_atoms': n_atoms, 'stages': {'run': {'status': 'error', 'error': proc.stderr[-2000:]}}}
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        if best is None:
+            best = result
+            continue
+        for name, stage in result['stages'].items():
+            if stage['status'] == 'ok' and best['stages'].get(name, {}).get('status') == 'ok':
+                best['stages'][name]['time'] = min(best['stages'][name]['time'], stage['time'])
+        best['peak_rss'] = max(best['peak_rss'], result['peak_rss'])
+    return best
+
+
+def run_suite(sizes, root=NANOCAR_DIR, repeat=1):
+    """Benchmark all sizes and return a history record."""
+    record = {'commit': git(['rev-parse', 'HEAD'], root), 'dirty': bool(git(['status', '--porcelain'], root)),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+              'repeat': repeat, 'sizes': {}}
+    for n_atoms in sizes:
+        result = run_size(n_atoms, root, repeat)
+        record['sizes'][str(n_atoms)] = result
+        print_result(n_atoms, result)
+    return record
+
+
+def print_result(n_atoms, result):
+    """Print stage times and memory for one system size."""
+    print('%i atoms (target %i)' % (result['n_atoms'], n_atoms))
+    for name, stage in result['stages'].items():
+        if stage['status'] == 'ok':
+            print('  %-18s %10.3f s %10.1f MB' % (name, stage['time'], stage['rss']))
+        else:
+            print('  %-18s FAILED\n%s' % (name, stage['error']))
+
+
+def failed(record):
+    """True if any stage of a record failed."""
+    return any(stage['status'] != 'ok' for size in record['sizes'].values() for stage in size['stages'].values())
+
+
+def read_history(history_file=HISTORY_FILE):
+    """All benchmark records in the history file."""
+    records = []
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def append_history(record, history_file=HISTORY_FILE):
+    """Append a benchmark record to the history file."""
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def git(args, root=NANOCAR_DIR):
+    """Output of a git command run in root."""
+    return subprocess.run(['git'] + args, cwd=root, check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+def commit_record(ref, sizes, repeat=1, history_file=HISTORY_FILE):
+    """
+    Latest history record of a commit (without uncommitted changes) that covers all sizes.
+    If there is none the commit is benchmarked in a temporary worktree and the record is added to the history.
+    """
+    commit = git(['rev-parse', ref])
+    for record in reversed(read_history(history_file)):
+        if record['commit'] == commit and not record['dirty'] and all(str(n) in record['sizes'] for n in sizes):
+            return record
+    print('Benchmarking %s (%s)' % (ref, commit[:10]))
+    worktree = tempfile.mkdtemp(prefix='nanocar-bench-worktree-')
+    git(['worktree', 'add', '--detach', worktree, commit])
+    try:
+        record = run_suite(sizes, worktree, repeat)
+    finally:
+        git(['worktree', 'remove', '--force', worktree])
+    append_history(record, history_file)
+    return record
+
+
+def compare(base, head, threshold=0.2):
+    """Print stage times of two records and return regressions (stages slower by more than threshold)."""
+    regressions = []
+    print('%-10s %-18s %10s %10s %8s' % ('Atoms', 'Stage', 'Base (s)', 'Head (s)', 'Change'))
+    print('-' * 62)
+    for size in base['sizes']:
+        if size not in head['sizes']:
+            continue
+        base_stages, head_stages = base['sizes'][size]['stages'], head['sizes'][size]['stages']
+        for name, stage in head_stages.items():
+            old = base_stages.get(name, {})
+            if stage['status'] != 'ok' or old.get('status') != 'ok':
+                print('%-10s %-18s %10s %10s %8s' % (size, name, old.get('status', '-'), stage['status'], ''))
+                continue
+            change = (stage['time'] - old['time']) / max(old['time'], 1e-9)
+            flag = ''
+            if change > threshold and stage['time'] - old['time'] > MIN_DIFFERENCE:
+                flag = '  REGRESSION'
+                regressions.append((size, name, old['time'], stage['time']))
+            print('%-10s %-18s %10.3f %10.3f %+7.0f%%%s' % (size, name, old['time'], stage['time'], 100 * change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the nanocar build and setup pipeline.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES, help='Target number of atoms.')
+    parser.add_argument('--repeat', '-r', type=int, default=1, help='Runs per size (fastest is kept).')
+    parser.add_argument('--history', type=str, default=HISTORY_FILE, help='History file (JSON lines).')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), default=None,
+                        help='Compare two commits (benchmarked in a worktree if not in the history).')
+    parser.add_argument('--threshold', '-t', type=float, default=0.2,
+                        help='Relative slowdown flagged as regression (default: 0.2).')
+    parser.add_argument('--child', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--root', type=str, default=NANOCAR_DIR, help=argparse.SUPPRESS)
+    args = vars(parser.parse_args())
+
+    if args['child'] is not None:
+        print(json.dumps(run_stages(args['child'], args['root'])))
+    elif args['compare'] is not None:
+        base = commit_record(args['compare'][0], args['sizes'], args['repeat'], args['history'])
+        head = commit_record(args['compare'][1], args['sizes'], args['repeat'], args['history'])
+        regressions = compare(base, head, args['threshold'])
+        print('%i regressions' % len(regressions))
+        sys.exit(1 if regressions or failed(head) else 0)
+    else:
+        record = run_suite(args['sizes'], NANOCAR_DIR, args['repeat'])
+        append_history(record, args['history'])
+        sys.exit(1 if failed(record) else 0)
@@ -0,0 +1,100 @@
+"""
+Cold vs warm plug-in command latency.
+Runs plug-in scripts the way Avogadro does (a fresh interpreter per call), first
+without the resident worker (cold) and then with a worker running (warm).
+
+Usage:
+ >>> python benchmarks/worker_latency.py --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+
+NANOCAR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def sample_cjson():
+    """Small chassis-like molecule with one bonded atom selected."""
+    coords = [0.0, 0.0, 0.0, 1.4, 0.0, 0.0, 2.1, 1.2, 0.0, 3.5, 1.2, 0.0]
+    return {'atoms': {'coords': {'3d': coords},
+                      'elements': {'number': [6, 6, 6, 6]},
+                      'selected': [False, False, False, True]},
+            'bonds': {'connections': {'index': [0, 1, 1, 2, 2, 3]}}}
+
+
+def benchmark_cases():
+    """Plug-in calls to time as (label, script, args, stdin)."""
+    chassis = {'chassis': 'chassis-H2-cd', 'center-x': 0.0, 'center-y': 0.0, 'center-z': 0.0}
+    wheel = {'cjson': sample_cjson(), 'wheel': 'C60', 'append': True, 'd': 1.5}
+    return [('add_chassis --display-name', 'add_chassis.py', ['--display-name'], None),
+            ('add_chassis --print-options', 'add_chassis.py', ['--print-options'], None),
+            ('add_chassis --run-command', 'add_chassis.py', ['--run-command'], json.dumps(chassis)),
+            ('connect_wheel --print-options', 'connect_wheel.py', ['--print-options'], None),
+            ('connect_wheel --run-command', 'connect_wheel.py', ['--run-command'], json.dumps(wheel)),
+            ('surface_builder --print-options', 'surface_builder.py', ['--print-options'], None),
+            ('lammps_setup --print-options', 'lammps_setup.py', ['--print-options'], None)]
+
+
+def time_call(script, args, stdin, env, repeat):
+    """Best wall time of running a plug-in script in a fresh interpreter."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(NANOCAR_DIR, script)] + args, input=stdin,
+                       env=env, cwd=NANOCAR_DIR, check=True, text=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def wait_for_socket(socket_file, timeout=60):
+    """Wait until the worker accepts connections."""
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_file)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError('Worker did not start in %i s' % timeout)
+
+
+def run_benchmark(repeat):
+    """Time all cases cold and warm, print a table and return the results."""
+    socket_file = os.path.join(tempfile.mkdtemp(), 'nanocar-worker.sock')
+    env = dict(os.environ, NANOCAR_WORKER_SOCKET=socket_file)
+    cases = benchmark_cases()
+
+    cold = [time_call(script, args, stdin, dict(env, NANOCAR_WORKER='0'), repeat) for _, script, args, stdin in cases]
+
+    worker = subprocess.Popen([sys.executable, os.path.join(NANOCAR_DIR, 'nanocar_worker.py'), '--socket', socket_file],
+                              env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_socket(socket_file)
+        warm = [time_call(script, args, stdin, env, repeat) for _, script, args, stdin in cases]
+    finally:
+        subprocess.run([sys.executable, os.path.join(NANOCAR_DIR, 'nanocar_worker.py'), '--stop', '--socket', socket_file],
+                       env=env, stdout=subprocess.DEVNULL)
+        worker.wait()
+
+    print('%-36s %10s %10s %8s' % ('Command', 'Cold (ms)', 'Warm (ms)', 'Speedup'))
+    print('-' * 67)
+    results = []
+    for (label, *_), t_cold, t_warm in zip(cases, cold, warm):
+        print('%-36s %10.1f %10.1f %7.1fx' % (label, t_cold * 1e3, t_warm * 1e3, t_cold / t_warm))
+        results.append({'command': label, 'cold': t_cold, 'warm': t_warm})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold vs warm plug-in command latency.')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Repeats per command (best is reported).')
+    args = vars(parser.parse_args())
+
+    run_benchmark(args['repeat'])
@@ -0,0 +1,115 @@
+"""
+Reader for LAMMPS binary dump files (dump custom with a .bin file name).
+The file is memory mapped and frame headers are indexed once on opening. Atom data of a frame
+is returned as a numpy view into the map without copying (frames written by several MPI
+processes are stored in several chunks and are joined into a single array).
+Views are only valid while the dump file is open.
+
+Usage:
+ >>> with BinaryDump('traj.bin') as dump:
+ ...     for timestep, box, data in dump:
+ ...         xyz = data[:, 3:6]
+"""
+import mmap
+import struct
+import numpy as np
+
+
+# Column names for dumps written without them (LAMMPS versions before the revision 2 format)
+DEFAULT_COLUMNS = {5: ['id', 'type', 'xu', 'yu', 'zu'],
+                   6: ['id', 'mol', 'type', 'xu', 'yu', 'zu']}
+
+
+class BinaryDump:
+    """Memory mapped LAMMPS binary dump with one header record per frame."""
+    def __init__(self, dump_file):
+        self.dump_file = dump_file
+        self._file = open(dump_file, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self._mm = b''
+        self.frames = self._index()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        for idx in range(len(self.frames)):
+            yield self.frame(idx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the memory map (it stays alive until views of it are garbage collected)."""
+        if isinstance(self._mm, mmap.mmap):
+            try:
+                self._mm.close()
+            except BufferError:
+                pass
+        self._file.close()
+
+    def frame(self, idx):
+        """Timestep, box bounds (3 x 2) and atom data (n_atoms x n_columns view) of a frame."""
+        header = self.frames[idx]
+        n_columns = len(header['columns'])
+        chunks = [np.frombuffer(self._mm, dtype=np.float64, count=n, offset=offset)
+                  for offset, n in header['chunks']]
+        data = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        return header['timestep'], header['box'], data.reshape(-1, n_columns)
+
+    def columns(self, idx):
+        """Atom data of a frame as a dict of column views."""
+        timestep, box, data = self.frame(idx)
+        return timestep, box, {name: data[:, i] for i, name in enumerate(self.frames[idx]['columns'])}
+
+    def _index(self):
+        """Parse all frame headers: timestep, number of atoms, box, column names and data chunks."""
+        mm, pos, frames = self._mm, 0, []
+        while pos < len(mm):
+            timestep, = struct.unpack_from('=q', mm, pos)
+            pos += 8
+            revision = 1
+            if timestep < 0:
+                # Format with magic string, endian flag and revision number
+                pos += -timestep
+                endian, revision = struct.unpack_from('=ii', mm, pos)
+                if endian != 1:
+                    raise ValueError('Dump file %s has a different byte order' % self.dump_file)
+                timestep, = struct.unpack_from('=q', mm, pos + 8)
+                pos += 16
+            n_atoms, triclinic = struct.unpack_from('=qi', mm, pos)
+            pos += 12 + 24
+            if triclinic not in (0, 1):
+                raise ValueError('Unsupported box in dump file %s' % self.dump_file)
+            box = np.array(struct.unpack_from('=6d', mm, pos)).reshape(3, 2)
+            pos += 48 + 24 * triclinic
+            size_one, = struct.unpack_from('=i', mm, pos)
+            pos += 4
+            columns = DEFAULT_COLUMNS.get(size_one, ['c%i' % i for i in range(size_one)])
+            if revision > 1:
+                # Units, time and column names
+                length, = struct.unpack_from('=i', mm, pos)
+                pos += 4 + length
+                pos += 1 + (8 if mm[pos] else 0)
+                length, = struct.unpack_from('=i', mm, pos)
+                columns = bytes(mm[pos + 4:pos + 4 + length]).decode().split()
+                pos += 4 + length
+            n_chunks, = struct.unpack_from('=i', mm, pos)
+            pos += 4
+            chunks = []
+            for _ in range(n_chunks):
+                n, = struct.unpack_from('=i', mm, pos)
+                chunks.append((pos + 4, n))
+                pos += 4 + 8 * n
+            if pos > len(mm):
+                # Frame still being written
+                break
+            frames.append({'timestep': timestep, 'n_atoms': n_atoms, 'box': box, 'columns': columns,
+                           'chunks': chunks})
+        return frames
@@ -0,0 +1,71 @@
+"""
+Cell list for distance queries on Nanocar atoms.
+Points are binned into cubic cells with the size of the cutoff distance so that each query
+only compares against points in the 27 surrounding cells. All queries are done at once
+with numpy (no Python loop over atoms).
+"""
+import itertools
+import numpy as np
+
+
+NEIGHBOR_CELLS = np.array(list(itertools.product([-1, 0, 1], repeat=3)), dtype=np.int64)
+CHUNK_SIZE = 20000
+
+
+class CellList:
+    """Points binned into cubic cells of size cutoff, sorted by cell index."""
+    def __init__(self, points, cutoff):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.cutoff = float(cutoff)
+        self.origin = points.min(axis=0) if len(points) > 0 else np.zeros(3)
+        cells = self._cells(points)
+        self.shape = cells.max(axis=0) + 1 if len(points) > 0 else np.ones(3, dtype=np.int64)
+        keys = self._keys(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.points = points[self.order]
+
+    def pairs(self, queries):
+        """
+        All (query, point) pairs closer than the cutoff distance.
+        Returns query indices, point indices (in the original point order) and distances.
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+        keys = self._keys((self._cells(queries)[:, None, :] + NEIGHBOR_CELLS).reshape(-1, 3))
+        start = np.searchsorted(self.keys, keys, side='left')
+        counts = np.searchsorted(self.keys, keys, side='right') - start
+        # Expand each (query, cell) into the points stored in that cell
+        q_idx = np.repeat(np.arange(len(queries)).repeat(len(NEIGHBOR_CELLS)), counts)
+        p_idx = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        diff = queries[q_idx] - self.points[p_idx]
+        d2 = np.einsum('ij,ij->i', diff, diff)
+        close = d2 < self.cutoff ** 2
+        return q_idx[close], self.order[p_idx[close]], np.sqrt(d2[close])
+
+    def min_distances(self, queries, exclude=None, skip=None):
+        """
+        Distance to the closest point for each query (inf if there are none within the cutoff).
+        Points listed in exclude are ignored, skip gives one point per query that is ignored for that query only.
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+        dmin = np.full(len(queries), np.inf)
+        for start in range(0, len(queries), CHUNK_SIZE):
+            q, p, d = self.pairs(queries[start:start + CHUNK_SIZE])
+            if exclude is not None:
+                keep = ~np.isin(p, exclude)
+                q, p, d = q[keep], p[keep], d[keep]
+            if skip is not None:
+                keep = p != skip[q + start]
+                q, d = q[keep], d[keep]
+            np.minimum.at(dmin, q + start, d)
+        return dmin
+
+    def _cells(self, points):
+        return np.floor((points - self.origin) / self.cutoff).astype(np.int64)
+
+    def _keys(self, cells):
+        """Flat cell index, -1 for cells outside the grid (which are always empty)."""
+        inside = ((cells >= 0) & (cells < self.shape)).all(axis=1)
+        keys = (cells[:, 0] * self.shape[1] + cells[:, 1]) * self.shape[2] + cells[:, 2]
+        keys[~inside] = -1
+        return keys
@@ -0,0 +1,160 @@
+"""
+Chemical JSON input and output for Nanocar plug-ins.
+Avogadro sends the whole document to every plug-in command. For documents with a large metal surface
+this is tens of MB of cjson, almost all of it in a few flat numeric arrays (coordinates, atomic numbers,
+bonds, bond orders and the selection). `loads` cuts these arrays out of the text before parsing the
+(small) remainder as JSON, with orjson if it is installed. The arrays are kept as JSONArray objects
+holding their text, which are parsed into numpy arrays (np.fromstring) only when a command uses them
+(np.asarray / np.array) and are written back unchanged by `dumps` without formatting them again.
+"""
+import re
+import json
+import warnings
+import numpy as np
+
+
+# Keys of the flat arrays read as JSONArray and their element type
+ARRAY_KEYS = {'3d': float, 'number': np.int64, 'index': np.int64, 'order': np.int64, 'selected': bool}
+_ARRAY_START = re.compile(r'"(%s)"\s*:\s*\[' % '|'.join(ARRAY_KEYS))
+_PLACEHOLDER = '\x00cjson:'
+_PLACEHOLDER_JSON = re.compile(r'"\\u0000cjson:(\d+)"')
+
+
+class JSONArray:
+    """
+    Flat JSON array kept as text (without brackets) and parsed into a read-only numpy array on first use.
+    Supports np.asarray / np.array, len, indexing and iteration.
+    """
+    __slots__ = ('text', 'dtype', '_values')
+
+    def __init__(self, text, dtype=float):
+        self.text, self.dtype, self._values = text, dtype, None
+
+    def values(self):
+        """Parsed (read-only) array."""
+        if self._values is None:
+            self._values = parse_array(self.text, self.dtype)
+            self._values.flags.writeable = False
+        return self._values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values() if dtype is None else self.values().astype(dtype, copy=False)
+        return values.copy() if copy else values
+
+    def __len__(self):
+        return len(self.values())
+
+    def __getitem__(self, idx):
+        return self.values()[idx]
+
+    def __iter__(self):
+        return iter(self.values().tolist())
+
+
+def parse_array(text, dtype=float):
+    """Parse the elements of a flat JSON array (text without brackets) into a numpy array."""
+    if not text.strip():
+        return np.zeros(0, dtype=dtype)
+    if dtype is bool:
+        return parse_array(text.replace('true', '1').replace('false', '0'), np.int8).astype(bool)
+    if dtype is float and _orjson() is not None:
+        # orjson parses floats about twice as fast as np.fromstring
+        return np.array(_orjson().loads('[%s]' % text), dtype=float)
+    with warnings.catch_warnings():
+        # Partially parsed text (e.g. floats in an integer array) raises instead of being truncated
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=dtype, sep=',')
+        except (DeprecationWarning, ValueError):
+            return np.array(json.loads('[%s]' % text), dtype=dtype)
+
+
+def loads(text):
+    """Parse plug-in input, keeping the flat arrays under ARRAY_KEYS as JSONArray."""
+    arrays, pieces, end = [], [], 0
+    for match in _ARRAY_START.finditer(text):
+        start = match.end()
+        if start < end:
+            continue
+        close = text.find(']', start)
+        if close < 0 or any(text.find(c, start, close) >= 0 for c in '[{"'):
+            # Not a flat array, parsed as usual
+            continue
+        pieces.append(text[end:start - 1])
+        pieces.append('"\\u0000cjson:%i"' % len(arrays))
+        arrays.append(JSONArray(text[start:close], ARRAY_KEYS[match.group(1)]))
+        end = close + 1
+    pieces.append(text[end:])
+    return _restore(_json_loads(''.join(pieces)), arrays)
+
+
+def dumps(obj):
+    """JSON text of a plug-in result. JSONArray objects are written as is and numpy arrays as lists."""
+    arrays = []
+
+    def default(o):
+        if isinstance(o, JSONArray):
+            arrays.append(o)
+            return '%s%i' % (_PLACEHOLDER, len(arrays) - 1)
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, np.generic):
+            return o.item()
+        raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+    text = _json_dumps(obj, default)
+    if not arrays:
+        return text
+    return _PLACEHOLDER_JSON.sub(lambda m: '[%s]' % arrays[int(m.group(1))].text, text)
+
+
+def concatenate(*arrays):
+    """
+    Join flat arrays (JSONArray, numpy arrays or lists). If any of them is a JSONArray the result is a JSONArray
+    and the text of JSONArray parts is not formatted again, otherwise it is a list (as in cjson_dict).
+    """
+    if not any(isinstance(a, JSONArray) for a in arrays):
+        return np.concatenate([np.asarray(a).reshape(-1) for a in arrays]).tolist()
+    parts = [a.text if isinstance(a, JSONArray) else dumps(np.asarray(a).reshape(-1))[1:-1] for a in arrays]
+    dtype = next(a.dtype for a in arrays if isinstance(a, JSONArray))
+    return JSONArray(','.join(p for p in parts if p.strip()), dtype)
+
+
+def _restore(obj, arrays):
+    """Put the arrays back in place of their placeholders."""
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, str) and value.startswith(_PLACEHOLDER):
+                obj[key] = arrays[int(value[len(_PLACEHOLDER):])]
+            elif isinstance(value, (dict, list)):
+                _restore(value, arrays)
+    elif isinstance(obj, list):
+        for value in obj:
+            if isinstance(value, (dict, list)):
+                _restore(value, arrays)
+    return obj
+
+
+def _orjson():
+    """orjson module, None if it is not installed."""
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def _json_loads(text):
+    orjson = _orjson()
+    return json.loads(text) if orjson is None else orjson.loads(text)
+
+
+def _json_dumps(obj, default):
+    orjson = _orjson()
+    if orjson is None:
+        return json.dumps(obj, default=default)
+    try:
+        return orjson.dumps(obj, default=default).decode()
+    except TypeError:
+        # Not supported by orjson (e.g. integers over 64 bits or non-string keys)
+        return json.dumps(obj, default=default)
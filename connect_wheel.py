@@ -9,21 +9,22 @@ import os
 import sys
 import json
 import argparse
-from angstrom import Molecule
-import numpy as np
-import periodictable
+from nanocar_worker import request
+from instrumentation import stage, run, dumps, debug_modes
 
 
 # Some globals:
 debug = True
+# Clearance between wheels and the rest of the molecule is measured up to this distance (Å)
+CLEARANCE_CUTOFF = 4.0
 
 wheel_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'wheel')
-wheel_list = [i.split('.')[0] for i in os.listdir(wheel_dir)]
 PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
 def get_options():
     """Create user interface options."""
+    wheel_list = sorted(os.path.splitext(i)[0] for i in os.listdir(wheel_dir) if i.endswith('.xyz'))
     user_options = {}
     user_options['wheel'] = {'label': 'Wheel',
                              'type': 'stringList',
@@ -40,112 +41,258 @@ def get_options():
                          'default': 1.5,
                          'suffix': 'Å'}
 
+    user_options['spin'] = {'label': 'Spin Search Steps',
+                            'type': 'integer',
+                            'default': 0,
+                            'minimum': 0,
+                            'maximum': 360}
+
+    user_options['clash'] = {'label': 'Clash Distance',
+                             'type': 'float',
+                             'precision': 2,
+                             'default': 2.0,
+                             'suffix': 'Å'}
+
     return {'userOptions': user_options }
 
 
 def connect_wheel(opts):
     """
-    Connect wheel molecule to selected atom position.
+    Connect wheel molecule to selected atom positions.
     The wheel molecule must have a connection site (Xc) and alignmen site (Xa) to specify connectivity.
-    The selected wheel molecule is added to selected atom by aligning the vector of the wheel.
+    A copy of the selected wheel molecule is added to each selected atom by aligning the vector of the wheel.
+    All wheels are aligned and translated at once and returned as Chemical JSON with bonds.
+    If append is True only the wheels are returned, otherwise the whole molecule (with
+    chassis - wheel bonds) is returned with the wheels added after the existing atoms
+    (existing coordinates and bonds are passed back as their input text, see cjson_io).
+    In both cases the chassis - wheel (axle) bonds are stored under properties -> axleBonds as flat
+    pairs of 0-based atom indices in the document after the wheels are added (empty for interlocked wheels).
+    Each wheel is checked for clashes with the chassis and the other wheels (optionally
+    spinning it about its axle to find the best clearance), the minimum distance for each
+    wheel is stored under properties -> wheelClearance.
     """
-    selected = [idx for idx, atm in enumerate(opts['cjson']['atoms']['selected']) if atm]
-    if len(selected) == 1:
+    import numpy as np
+    from topology import build_adjacency, degree, neighbor_mean
+    from molecule_writer import cjson_dict
+    from cjson_io import concatenate
+    from molecule_library import axle_rotations
+    selected = selected_atoms(opts['cjson'])
+    if len(selected) > 0:
         # Get chassi coordinates and bonds
-        coords = np.array(opts['cjson']['atoms']['coords']['3d'])
+        coords = np.asarray(opts['cjson']['atoms']['coords']['3d'], dtype=float).reshape(-1, 3)
         connections = opts['cjson']['bonds']['connections']['index']
-        atoms = [periodictable.elements[i].symbol for i in opts['cjson']['atoms']['elements']['number']]
-        chassi = Molecule(atoms=atoms, coordinates=np.array(coords).reshape((int(len(coords) / 3)), 3))
 
-        # Get connection site for the chassis
-        selected_cidx = int(selected[0] * 3)
-        selected_coors = coords[selected_cidx:selected_cidx + 3]
+        # Get connection sites for the chassis
+        selected_coors = coords[selected]
 
-        # Find atom connected to the selected atom
-        bond_idx = connections.index(selected[0])
-        if bond_idx % 2 == 0:
-            bond_idx += 1
-        else:
-            bond_idx -= 1
-        bond_idx = int(connections[bond_idx] * 3)
+        # Find atoms connected to the selected atoms
+        offsets, neighbors = build_adjacency(connections, len(coords))
+        if (degree(offsets, selected) == 0).any():
+            print('Selected atoms must be bonded to at least 1 atom!')
+            return None
 
-        # Get vector btw selected atom and atom connected to it
-        v_chassi = selected_coors - np.array(coords[bond_idx:bond_idx + 3])
+        # Get vectors btw selected atoms and the mean position of atoms connected to them
+        v_chassi = selected_coors - neighbor_mean(offsets, neighbors, coords, selected)
 
         # Read wheel molecule information
-        wheel = read_wheel(opts['wheel'])
-
-        # Align the wheel with chassis connection vector
-        v_wheel = wheel.coordinates[wheel.alignment_site] - wheel.coordinates[wheel.connection_site]
-        wheel.align(v_wheel, v_chassi)
+        with stage('read_wheel'):
+            wheel = read_wheel(opts['wheel'])
+
+        # Rotations aligning the wheel axle (alignment vector) with each chassis connection vector
+        with stage('align', atoms=len(selected)):
+            rotations = alignment_matrices(wheel.alignment_vector, v_chassi)
+
+        # Wheel atoms relative to the alignment site (dummy atoms for alignment and connection sites removed),
+        # the alignment site of each wheel is placed at bond distance from the selected atom along the axle
+        dummies = [wheel.connection_site, wheel.alignment_site]
+        local = np.delete(wheel.coordinates - wheel.coordinates[wheel.alignment_site], dummies, axis=0)
+        wheel_numbers = np.delete(wheel.numbers, dummies)
+        origins = selected_coors + opts['d'] * v_chassi / np.linalg.norm(v_chassi, axis=1)[:, None]
+
+        # Re-index wheel bonds and the anchor atom (bonded to chassis) after removing dummy atoms
+        new_index = np.cumsum(~np.isin(np.arange(len(wheel.numbers)), dummies)) - 1
+        n_wheel, n_sites = len(wheel_numbers), len(selected)
+        copy_offsets = n_wheel * np.arange(n_sites)
+        bonds = (new_index[wheel.bonds][None] + copy_offsets[:, None, None]).reshape(-1, 2)
+        numbers = np.tile(wheel_numbers, n_sites)
+
+        # Place the wheels and check them for clashes, spinning them about the axle if requested
+        spins = axle_rotations(wheel.axle_rotations, wheel.alignment_vector, opts.get('spin', 0))
+        with stage('place_wheels', atoms=len(numbers) * len(spins)):
+            anchor = new_index[wheel.anchor_site] if wheel.anchor_site >= 0 else None
+            wheel_coords, clearance = place_wheels(coords, selected, local, rotations, origins, anchor, spins)
+        clashes = clearance < opts.get('clash', 2.0)
+        if clashes.any():
+            sys.stderr.write('Wheel clash at atoms %s (minimum distance: %s Å)\n'
+                             % (np.array(selected)[clashes].tolist(), np.round(clearance[clashes], 2).tolist()))
+        wheel_coords = wheel_coords.reshape(-1, 3)
+
+        # Chassis atoms keep their ids and wheels are added after them,
+        # interlocked wheels (no anchor atom) are not bonded to the chassis
+        n_chassi = len(coords)
+        if wheel.anchor_site >= 0:
+            axle_bonds = np.column_stack([selected, n_chassi + new_index[wheel.anchor_site] + copy_offsets])
+        else:
+            axle_bonds = np.zeros((0, 2), dtype=np.int64)
+        with stage('cjson', atoms=len(numbers) if opts['append'] else len(numbers) + len(coords)):
+            if opts['append']:
+                wheels = cjson_dict(numbers, wheel_coords, bonds, name=wheel.name)
+            else:
+                chassi_orders = opts['cjson']['bonds'].get('order', np.ones(len(connections) // 2, dtype=int))
+                wheels = cjson_dict(np.concatenate([opts['cjson']['atoms']['elements']['number'], numbers]), [])
+                wheels['atoms']['coords']['3d'] = concatenate(opts['cjson']['atoms']['coords']['3d'], wheel_coords)
+                wheels['bonds'] = {'connections': {'index': concatenate(connections, bonds + n_chassi, axle_bonds)},
+                                   'order': concatenate(chassi_orders, np.ones(len(bonds), dtype=int),
+                                                        np.ones(len(axle_bonds), dtype=int))}
+        wheels['properties'] = {'wheelClearance': np.round(clearance, 3).tolist(),
+                                'axleBonds': axle_bonds.ravel().tolist()}
+    else:
+        print('At least 1 atom should be selected!')
+        wheels = None
 
-        # Translate the wheel to match dummy coor with selected coor
-        v_trans = selected_coors - wheel.coordinates[wheel.connection_site]
-        wheel.translate(v_trans)
+    return wheels
 
-        # Adjust bond distance
-        v_bond = wheel.coordinates[wheel.connection_site] - wheel.coordinates[wheel.alignment_site]
-        d_bond = np.linalg.norm(v_bond)
-        v_bond = v_bond - v_bond / d_bond * opts['d']
-        wheel.translate(v_bond)
 
-        # Remove dummy atoms for alignment and connection sites
-        wheel.coordinates = np.delete(wheel.coordinates, [wheel.connection_site, wheel.alignment_site], axis=0)
-        wheel.atoms = np.delete(wheel.atoms, [wheel.connection_site, wheel.alignment_site])
+def selected_atoms(cjson):
+    """Indices of the selected atoms."""
+    import numpy as np
+    return np.flatnonzero(np.asarray(cjson['atoms']['selected'], dtype=bool)).tolist()
 
-        # Write wheel atom ids to file for grouping
-        # wheel_info = {'name': opts['wheel'], 'start': len(chassi.atoms), 'n_atoms': len(wheel.atoms)}
-        # write_wheel_list(wheel_info, refresh=opts['refresh_wheel_list'])
 
-        if not opts['append']:
-            wheel += chassi
+def place_wheels(coords, selected, local, rotations, origins, anchor, spins=None, cutoff=CLEARANCE_CUTOFF):
+    """
+    Place wheels (local coordinates relative to the alignment site) on the chassis and return their
+    coordinates (n_wheels, n_atoms, 3) with the minimum distance between each wheel and the chassis /
+    other wheels (capped at cutoff). Wheel k in spin orientation s is rotations[k] @ spins[s] @ local + origins[k].
+    Bonded chassis atoms (the selected atoms) and the wheel anchor atoms are not counted. Wheels without
+    an anchor (anchor None, interlocked wheels) are not bonded, so all their atoms and the sites are counted.
+    With several spins (rotations about the axle, see molecule_library.axle_rotations) all wheels in all
+    spins are built and checked against the chassis at once, then each wheel is placed with the spin that
+    has the largest clearance, one wheel after the other.
+    """
+    import numpy as np
+    from cell_list import CellList
+    spins = np.eye(3)[None] if spins is None else spins
+    n_wheels, n_spins, n_atoms = len(selected), len(spins), len(local)
+    # All orientations of all wheels: (n_wheels, n_spins, n_atoms, 3)
+    orientations = np.einsum('kij,sjl->ksil', rotations, spins)
+    candidates = np.einsum('ksij,nj->ksni', orientations, local) + origins[:, None, None]
+    # Chassis clearance of every candidate, ignoring the chassis atom bonded to each wheel
+    chassis = CellList(coords, cutoff)
+    sites = np.repeat(np.asarray(selected, dtype=np.int64), n_spins * n_atoms) if anchor is not None else None
+    dchassis = chassis.min_distances(candidates.reshape(-1, 3), skip=sites).reshape(n_wheels, n_spins, n_atoms)
+    placed = candidates[:, 0].copy()
+    clearance = np.full(n_wheels, float(cutoff))
+    not_anchor = np.arange(n_atoms) != (-1 if anchor is None else anchor)
+    for k in range(n_wheels):
+        dmin = dchassis[k]
+        # Other wheels: already placed ones at their final position, later ones at their initial position
+        others = np.delete(placed, k, axis=0).reshape(-1, 3)
+        if len(others) > 0:
+            dmin = np.minimum(dmin, CellList(others, cutoff).min_distances(candidates[k]).reshape(n_spins, -1))
+        spin_clearance = dmin[:, not_anchor].min(axis=1) if not_anchor.any() else np.full(n_spins, np.inf)
+        best = int(np.argmax(spin_clearance))
+        placed[k] = candidates[k, best]
+        clearance[k] = min(spin_clearance[best], cutoff)
+    if n_spins > 1:
+        # Clearance of earlier wheels may have changed when later wheels were spun
+        for k, site in enumerate(selected):
+            others = np.delete(placed, k, axis=0).reshape(-1, 3)
+            d = chassis.min_distances(placed[k][not_anchor], exclude=[site] if anchor is not None else None)
+            if len(others) > 0:
+                d = np.minimum(d, CellList(others, cutoff).min_distances(placed[k][not_anchor]))
+            clearance[k] = min(d.min(), cutoff) if len(d) > 0 else cutoff
+    return placed, clearance
+
+
+def alignment_matrices(vector, targets):
+    """
+    Rotation matrices that align a vector with each of the target vectors (Rodrigues' formula).
+    Returns an array of shape (n_targets, 3, 3).
+    """
+    import numpy as np
+    v = vector / np.linalg.norm(vector)
+    t = targets / np.linalg.norm(targets, axis=1)[:, None]
+    axis = np.cross(v, t)
+    sin = np.linalg.norm(axis, axis=1)
+    cos = t @ v
+    parallel = sin < 1e-8
+    axis[~parallel] /= sin[~parallel, None]
+    # Antiparallel vectors: rotate 180 degrees about any axis perpendicular to the vector
+    perp = np.cross(v, np.eye(3)[np.argmin(np.abs(v))])
+    axis[parallel] = perp / np.linalg.norm(perp)
+    k = np.zeros((len(t), 3, 3))
+    k[:, 0, 1], k[:, 0, 2], k[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    k -= k.transpose(0, 2, 1)
+    return np.eye(3) + sin[:, None, None] * k + (1 - cos)[:, None, None] * k @ k
 
-        wheel = mol2xyz(wheel)
-    else:
-        print('Only 1 atom should be selected!')
-        wheel = None
 
+def read_wheel(wheel_name):
+    """Read wheel from compiled wheel library to Molecule object (with bonds, sites and descriptors)"""
+    from angstrom import Molecule
+    from molecule_library import load_library, get_molecule, DESCRIPTOR_SHAPES
+    entry = get_molecule(load_library(wheel_dir), wheel_name)
+    wheel = Molecule(atoms=entry['atoms'], coordinates=entry['coordinates'])
+    wheel.name = wheel_name
+    wheel.numbers = entry['numbers']
+    wheel.bonds = entry['bonds']
+    # Wheel atom bonded to the chassis (-1 for interlocked wheels)
+    wheel.anchor_site = entry['anchor_site']
+    wheel.connection_site = entry['connection_site']
+    wheel.alignment_site = entry['alignment_site']
+    wheel.alignment_vector = entry['alignment_vector']
+    # Rigid body descriptors (centroid, inertia, principal axes, radius and axle rotations)
+    for key in DESCRIPTOR_SHAPES:
+        setattr(wheel, key, entry[key])
     return wheel
 
 
-def mol2xyz(mol):
-    """Converts Angstrom Molecule to xyz string"""
-    mol_xyz = "%i\n%s\n" % (len(mol.atoms), mol.name)
-    for atom, coor in zip(mol.atoms, mol.coordinates):
-        mol_xyz += "%s %f %f %f\n" % (atom, coor[0], coor[1], coor[2])
-    return mol_xyz
-
+def wheel_components(name, sites, n_wheel, first=1, anchor=None):
+    """
+    Scene components for wheels connected to chassis sites (0-based), wheel atoms start at id first.
+    anchor is the index of the wheel atom bonded to the site (0-based, within a wheel), stored as atom id,
+    -1 for interlocked wheels that are not bonded to the site.
+    """
+    components = [{'kind': 'wheel', 'name': name, 'id': [first + k * n_wheel, first + (k + 1) * n_wheel - 1],
+                   'site': int(site) + 1} for k, site in enumerate(sites)]
+    if anchor is not None:
+        for component in components:
+            if anchor < 0:
+                component['interlocked'] = True
+            else:
+                component['anchor'] = component['id'][0] + int(anchor)
+    return components
 
-def read_wheel(wheel_name):
-    """Read yaml file to Molecule object"""
-    wheel = Molecule(read=os.path.join(wheel_dir, '%s.xyz' % wheel_name))
-    wheel.connection_site, = np.where(wheel.atoms == 'Xc')[0]
-    wheel.alignment_site, = np.where(wheel.atoms == 'Xa')[0]
-    return wheel
 
+def anchor_index(wheels, n_before):
+    """Index of the anchor atom within a wheel from the axle bonds of a connect_wheel reply (-1 if there are none)."""
+    axle_bonds = wheels['properties']['axleBonds']
+    return axle_bonds[1] - n_before if len(axle_bonds) > 0 else -1
 
-def write_wheel_list(wheel_info, refresh=False):
-    """Write atom ids for the connected wheel to keep track of atom groupings"""
-    wheel_list_file = os.path.join(PLUGIN_DIR, 'wheel_list.json')
-    if os.path.exists(wheel_list_file) and not refresh:
-        # Read and append new wheel if we don't want to refresh
-        with open(wheel_list_file, 'r') as outfile:
-            wheels = json.load(outfile)
-        wheel_list = wheels + [wheel_info]
-    else:
-        wheel_list = [wheel_info]
-    with open(wheel_list_file, 'w') as outfile:
-        json.dump(wheel_list, outfile)
 
-def run_command():
+def run_command(stdinStr=None):
     """Run main function - add wheel."""
-    stdinStr = sys.stdin.read()
-    opts = json.loads(stdinStr)
+    if stdinStr is None:
+        stdinStr = sys.stdin.read()
+    from cjson_io import loads
+    with stage('parse_input', nbytes=len(stdinStr)):
+        opts = loads(stdinStr)
 
-    result = opts['cjson']
+    result = {}
     result['append'] = opts['append']
-    result['moleculeFormat'] = 'xyz'
-    result['xyz'] = connect_wheel(opts)
+    result['moleculeFormat'] = 'cjson'
+    result['cjson'] = connect_wheel(opts)
+    if result['cjson'] is not None:
+        # Keep track of the wheel atoms in the document (wheels are added after the existing atoms)
+        from scene_state import record_components, document_numbers
+        before = document_numbers(opts)
+        numbers = result['cjson']['atoms']['elements']['number']
+        new_numbers = numbers if opts['append'] else numbers[len(before):]
+        sites = selected_atoms(opts['cjson'])
+        with stage('record_scene'):
+            record_components(before, new_numbers,
+                              wheel_components(opts['wheel'], sites, len(new_numbers) // len(sites),
+                                               anchor=anchor_index(result['cjson'], len(before))))
     return result
 
 
@@ -159,13 +306,18 @@ if __name__ == "__main__":
     parser.add_argument('--lang', nargs='?', default='en')
     args = vars(parser.parse_args())
 
-    debug = args['debug']
+    debug = debug_modes(args['debug'])
 
     if args['display_name']:
         print("Connect Wheel")
     if args['menu_path']:
         print("&Build|Nanocar")
     if args['print_options']:
-        print(json.dumps(get_options()))
+        reply = request('connect_wheel', 'print_options')
+        print(reply if reply is not None else json.dumps(get_options()))
     elif args['run_command']:
-        print(json.dumps(run_command()))
+        stdinStr = sys.stdin.read()
+        reply = request('connect_wheel', 'run_command', stdinStr, debug=debug)
+        if reply is None:
+            reply = run('connect_wheel', 'run_command', lambda: dumps(run_command(stdinStr)), modes=debug)
+        print(reply)
@@ -0,0 +1,57 @@
+"""
+Element tables for Nanocars.
+Symbols, masses and covalent radii are read from periodictable once per process into arrays
+indexed by atomic number, so element properties of a whole system are looked up with a single
+numpy indexing operation instead of a periodictable call per atom. Atoms are kept as atomic
+numbers and converted to symbols only where text is written.
+Atomic number 0 is used for dummy atoms (empty symbol, zero mass and radius).
+Lennard-Jones parameters are stored the same way, per force field (see forcefield.load_parameters).
+"""
+import numpy as np
+
+
+MAX_Z = 118
+
+# In-process element table (built on first use)
+_table = None
+
+
+def element_table():
+    """Element arrays indexed by atomic number (symbol, mass, covalent_radius) and a symbol -> number dict."""
+    global _table
+    if _table is None:
+        import periodictable
+        elements = [periodictable.elements[z] for z in range(1, MAX_Z + 1)]
+        _table = {'symbol': np.array([''] + [e.symbol for e in elements], dtype='U3'),
+                  'mass': np.array([0.0] + [e.mass for e in elements]),
+                  'covalent_radius': np.array([0.0] + [e.covalent_radius or 0.0 for e in elements]),
+                  'number': {e.symbol: e.number for e in elements}}
+    return _table
+
+
+def symbols(numbers):
+    """Element symbols for atomic numbers."""
+    return element_table()['symbol'][np.asarray(numbers, dtype=np.int64)]
+
+
+def masses(numbers):
+    """Atomic masses for atomic numbers."""
+    return element_table()['mass'][np.asarray(numbers, dtype=np.int64)]
+
+
+def covalent_radii(numbers):
+    """Covalent radii (Å) for atomic numbers (0 for dummy atoms and elements without a radius)."""
+    return element_table()['covalent_radius'][np.asarray(numbers, dtype=np.int64)]
+
+
+def atomic_numbers(element_symbols, extra=None):
+    """
+    Atomic numbers for element symbols.
+    Each distinct symbol is looked up once, extra maps additional symbols (e.g. dummy atoms) to numbers.
+    """
+    lookup = element_table()['number'] if extra is None else dict(element_table()['number'], **extra)
+    unique, inverse = np.unique(np.asarray(element_symbols), return_inverse=True)
+    unknown = [str(s) for s in unique if s not in lookup]
+    if unknown:
+        raise ValueError('Unknown element symbol(s): %s' % ', '.join(unknown))
+    return np.array([lookup[s] for s in unique], dtype=np.int64)[inverse.reshape(-1)]
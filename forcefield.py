@@ -0,0 +1,206 @@
+"""
+Force field parameters for Nanocars.
+Each Lennard-Jones parameter table (csv: element, distance, well depth) is parsed once into
+arrays indexed by atomic number and stored next to it as a compact .npz file, which is used
+until the csv file changes. Elements missing from a force field are taken from its parent (UFF).
+Bonded UFF parameters (bonds, angles, dihedrals) are assigned from uff_bonded.csv with the
+atom type picked by element and number of bonds.
+"""
+import os
+import csv
+import numpy as np
+from elements import MAX_Z, atomic_numbers
+
+
+PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
+# Force field -> (parameter table, parent force field for missing elements)
+FORCE_FIELDS = {'UFF': ('uff_nonbonded.csv', None),
+                'DREIDING': ('dreiding_nonbonded.csv', 'UFF')}
+RM_TO_SIGMA = 1 / (2 ** (1 / 6))
+# Symbols used in the parameter tables that differ from the element table
+ELEMENT_ALIASES = {'Lw': 'Lr', 'SI': 'Si'}
+UFF_BONDED_FILE = 'uff_bonded.csv'
+
+# In-process cache of loaded tables: force field -> parameters
+_tables = {}
+
+
+def load_parameters(forcefield='UFF'):
+    """Epsilon (kcal/mol) and sigma (Å) arrays indexed by atomic number (NaN for missing elements)."""
+    if forcefield in _tables:
+        return _tables[forcefield]
+    if forcefield not in FORCE_FIELDS:
+        raise ValueError('Unknown force field: %s' % forcefield)
+    csv_name, parent = FORCE_FIELDS[forcefield]
+    table = load_table(os.path.join(PLUGIN_DIR, csv_name))
+    parameters = {'eps': table['eps'].copy(), 'sig': table['sig'].copy()}
+    if parent is not None:
+        missing = np.isnan(parameters['eps'])
+        for key, values in load_parameters(parent).items():
+            parameters[key][missing] = values[missing]
+    _tables[forcefield] = parameters
+    return parameters
+
+
+def load_table(csv_file):
+    """Load a parameter table from its binary copy, parsing the csv file only if it changed."""
+    npz_file = os.path.join(os.path.dirname(csv_file), '.%s.npz' % os.path.splitext(os.path.basename(csv_file))[0])
+    mtime = os.path.getmtime(csv_file)
+    if os.path.exists(npz_file):
+        with np.load(npz_file) as npz:
+            table = dict(npz)
+        if float(table['mtime']) == mtime:
+            return table
+    table = read_table(csv_file)
+    table['mtime'] = np.array(mtime)
+    tmp_file = '%s.%i.tmp.npz' % (npz_file[:-4], os.getpid())
+    try:
+        np.savez(tmp_file, **table)
+        os.replace(tmp_file, npz_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return table
+
+
+def read_table(csv_file, skip_headers=True):
+    """Parse csv parameter table (element, distance, well depth) into arrays indexed by atomic number."""
+    eps, sig = np.full(MAX_Z + 1, np.nan), np.full(MAX_Z + 1, np.nan)
+    with open(csv_file, 'r') as f:
+        csv_reader = csv.reader(f, delimiter=',')
+        if skip_headers:
+            next(csv_reader, None)
+        rows = list(csv_reader)
+    z = atomic_numbers([ELEMENT_ALIASES.get(row[0], row[0]) for row in rows])
+    eps[z] = [float(row[2]) for row in rows]
+    sig[z] = [float(row[1]) * RM_TO_SIGMA for row in rows]
+    return {'eps': eps, 'sig': sig}
+
+
+def lj_parameters(numbers, forcefield='UFF'):
+    """Epsilon and sigma arrays for atomic numbers."""
+    numbers = np.asarray(numbers, dtype=np.int64)
+    parameters = load_parameters(forcefield)
+    eps, sig = parameters['eps'][numbers], parameters['sig'][numbers]
+    if np.isnan(eps).any():
+        raise ValueError('No %s parameters for atomic numbers %s' % (forcefield, np.unique(numbers[np.isnan(eps)])))
+    return eps, sig
+
+
+def pair_coefficients(numbers, forcefield='UFF', mixing='arithmetic'):
+    """
+    Mixed epsilon and sigma matrices for all pairs of the given atomic numbers (atom types).
+    Arithmetic (Lorentz-Berthelot) or geometric mixing as in LAMMPS pair_modify mix.
+    """
+    eps, sig = lj_parameters(numbers, forcefield)
+    pair_eps = np.sqrt(np.outer(eps, eps))
+    if mixing == 'arithmetic':
+        pair_sig = (sig[:, None] + sig[None, :]) / 2
+    elif mixing == 'geometric':
+        pair_sig = np.sqrt(np.outer(sig, sig))
+    else:
+        raise ValueError('Unknown mixing rule: %s' % mixing)
+    return pair_eps, pair_sig
+
+
+def load_bonded_parameters():
+    """UFF bonded atom types and parameters as arrays (one row per element and number of bonds)."""
+    if 'UFF-bonded' in _tables:
+        return _tables['UFF-bonded']
+    with open(os.path.join(PLUGIN_DIR, UFF_BONDED_FILE), 'r') as f:
+        rows = list(csv.reader(f, delimiter=','))[1:]
+    columns = list(zip(*rows))
+    table = {'type': np.array(columns[0]),
+             'number': atomic_numbers(columns[1]),
+             'degree': np.array(columns[2], dtype=np.int64)}
+    for key, column in zip(['r1', 'theta0', 'z1', 'chi', 'v', 'u'], columns[3:]):
+        table[key] = np.array(column, dtype=float)
+    # Hybridization from the type name (C_3 -> 3, C_R -> R, Si3 -> 3, H_ -> '')
+    table['hybrid'] = np.array([t[2:3] for t in table['type']])
+    _tables['UFF-bonded'] = table
+    return table
+
+
+def uff_atom_types(numbers, degrees):
+    """
+    Row of the UFF bonded table for each atom, picked by element and number of bonds
+    (the closest number of bonds listed for the element if there is no exact match).
+    """
+    table = load_bonded_parameters()
+    numbers, degrees = np.asarray(numbers), np.asarray(degrees)
+    types = np.full(len(numbers), -1, dtype=np.int64)
+    for z, d in set(zip(numbers.tolist(), degrees.tolist())):
+        rows = np.where(table['number'] == z)[0]
+        if len(rows) == 0:
+            raise ValueError('No UFF bonded parameters for atomic number %i' % z)
+        types[(numbers == z) & (degrees == d)] = rows[np.argmin(np.abs(table['degree'][rows] - d))]
+    return types
+
+
+def bond_order(types_i, types_j):
+    """Bond order used for UFF parameters: 1.5 between resonant atoms, 1 otherwise."""
+    hybrid = load_bonded_parameters()['hybrid']
+    return np.where((hybrid[types_i] == 'R') & (hybrid[types_j] == 'R'), 1.5, 1.0)
+
+
+def bond_lengths(types_i, types_j, orders=None):
+    """UFF natural bond lengths (Å) with bond order and electronegativity corrections."""
+    table = load_bonded_parameters()
+    ri, rj, xi, xj = table['r1'][types_i], table['r1'][types_j], table['chi'][types_i], table['chi'][types_j]
+    resonant = bond_order(types_i, types_j)
+    orders = resonant if orders is None else np.where(resonant > 1, resonant, orders)
+    r_bo = -0.1332 * (ri + rj) * np.log(orders)
+    r_en = ri * rj * (np.sqrt(xi) - np.sqrt(xj)) ** 2 / (xi * ri + xj * rj)
+    return ri + rj + r_bo - r_en
+
+
+def bond_parameters(types, bonds, orders=None):
+    """Harmonic bond coefficients (K in kcal/mol/Å² as in LAMMPS bond_style harmonic, r0 in Å)."""
+    table = load_bonded_parameters()
+    i, j = types[bonds[:, 0]], types[bonds[:, 1]]
+    r0 = bond_lengths(i, j, orders)
+    k = 664.12 * table['z1'][i] * table['z1'][j] / r0 ** 3
+    return np.column_stack([k / 2, r0])
+
+
+def angle_parameters(types, angles):
+    """Harmonic angle coefficients (K in kcal/mol/rad² as in LAMMPS angle_style harmonic, theta0 in degrees)."""
+    table = load_bonded_parameters()
+    i, j, k = types[angles[:, 0]], types[angles[:, 1]], types[angles[:, 2]]
+    theta0 = table['theta0'][j]
+    cos0 = np.cos(np.radians(theta0))
+    r_ij, r_jk = bond_lengths(i, j), bond_lengths(j, k)
+    r_ik2 = r_ij ** 2 + r_jk ** 2 - 2 * r_ij * r_jk * cos0
+    force = 664.12 * table['z1'][i] * table['z1'][k] / r_ik2 ** 2.5 * (3 * r_ij * r_jk * (1 - cos0 ** 2) - r_ik2 * cos0)
+    return np.column_stack([force / 2, theta0])
+
+
+def dihedral_parameters(types, dihedrals):
+    """
+    UFF torsion coefficients as LAMMPS dihedral_style harmonic (K in kcal/mol, d, n).
+    The barrier depends on the hybridization of the central atoms (sp3-sp3: n = 3, sp2-sp2: n = 2,
+    sp2-sp3: n = 6) and is divided by the number of dihedrals around the same central bond.
+    Dihedrals around linear (sp) atoms have no barrier (K = 0).
+    """
+    table = load_bonded_parameters()
+    j, k = types[dihedrals[:, 1]], types[dihedrals[:, 2]]
+    hj, hk = table['hybrid'][j], table['hybrid'][k]
+    sp3j, sp3k = hj == '3', hk == '3'
+    sp2j, sp2k = np.isin(hj, ['2', 'R']), np.isin(hk, ['2', 'R'])
+    barrier = np.zeros(len(dihedrals))
+    d, n = np.ones(len(dihedrals), dtype=np.int64), np.ones(len(dihedrals), dtype=np.int64)
+
+    sp3 = sp3j & sp3k
+    barrier[sp3], d[sp3], n[sp3] = np.sqrt(table['v'][j[sp3]] * table['v'][k[sp3]]), 1, 3
+    sp2 = sp2j & sp2k
+    order = bond_order(j[sp2], k[sp2])
+    barrier[sp2] = 5 * np.sqrt(table['u'][j[sp2]] * table['u'][k[sp2]]) * (1 + 4.18 * np.log(order))
+    d[sp2], n[sp2] = -1, 2
+    mixed = (sp2j & sp3k) | (sp3j & sp2k)
+    barrier[mixed], d[mixed], n[mixed] = 1.0, -1, 6
+
+    # Number of dihedrals sharing each central bond
+    central = np.sort(dihedrals[:, 1:3], axis=1)
+    _, bond_index, counts = np.unique(central, axis=0, return_inverse=True, return_counts=True)
+    barrier /= counts[bond_index.reshape(-1)]
+    return np.column_stack([barrier / 2, d, n])
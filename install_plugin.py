@@ -28,7 +28,13 @@ def copy_files(file_list, src_dir, dest_dir):
 def install_plugin(args):
     """Install nanocar plug-in: copy all scripts and required files."""
     files = ['add_chassis.py', 'connect_wheel.py', 'surface_builder.py',
-             'lammps_writer.py', 'lammps_setup.py', 'uff_nonbonded.csv']
+             'lammps_writer.py', 'lammps_setup.py', 'topology.py', 'molecule_library.py',
+             'nanocar_worker.py', 'molecule_writer.py', 'batch_builder.py',
+             'slab_cache.py', 'slab_lattice.py', 'cell_list.py',
+             'surface_placement.py', 'forcefield.py', 'uff_nonbonded.csv', 'dreiding_nonbonded.csv',
+             'uff_bonded.csv', 'trajectory.py', 'binary_dump.py',
+             'scene_state.py', 'instrumentation.py', 'elements.py',
+             'cjson_io.py']
     folders = ['wheel', 'chassis']
     cleanup = ['temp.xyz', 'surface_info.json', 'data.nanocar', 'in.nanocar', 'wheel_list.json']
 
@@ -53,7 +59,8 @@ def install_plugin(args):
         else:
             print('\nCreating %s molecules' % f)
         os.makedirs(fdir, exist_ok=True)
-        copy_files(os.listdir(os.path.join(nanocar_dir, f)),
+        # Compiled molecule libraries are rebuilt in the plug-in directory
+        copy_files([i for i in os.listdir(os.path.join(nanocar_dir, f)) if not i.startswith('.')],
                    os.path.join(nanocar_dir, f), fdir)
 
     # Cleanup files
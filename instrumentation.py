@@ -0,0 +1,202 @@
+"""
+Opt-in instrumentation for Nanocar plug-in commands.
+Enabled with the --debug flag of the plug-in scripts or the NANOCAR_DEBUG environment variable
+(comma separated modes: 'timing' (or '1'), 'profile' for cProfile and 'memory' for tracemalloc).
+Plug-in code marks named stages with `stage`, which records the wall time and the number of
+atoms and bytes processed. Stages can be nested. Each command run is appended as one JSON record
+to nanocar_debug.jsonl next to the plug-in (or NANOCAR_DEBUG_LOG).
+When instrumentation is off `stage` does nothing, and this module only uses the standard library
+so it is cheap to import from the plug-in scripts.
+
+Usage:
+ >>> NANOCAR_DEBUG=profile python lammps_setup.py --run-command < opts.json
+ >>> python instrumentation.py --last 5      # summarize recent records
+"""
+import os
+import sys
+import json
+import time
+
+
+PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
+ENV_VAR = 'NANOCAR_DEBUG'
+LOG_FILE = os.environ.get('NANOCAR_DEBUG_LOG', os.path.join(PLUGIN_DIR, 'nanocar_debug.jsonl'))
+PROFILE_DIR = os.path.join(os.path.dirname(LOG_FILE), 'nanocar_profiles')
+MODES = ['timing', 'profile', 'memory']
+# Number of functions (cProfile) and allocation sites (tracemalloc) kept in the log record
+TOP_ENTRIES = 25
+
+# Active session (None when instrumentation is off)
+_session = None
+
+
+class Session:
+    """Stage timings and counters of a single plug-in command run."""
+    def __init__(self, command, action, modes):
+        self.command, self.action, self.modes = command, action, sorted(modes)
+        self.stages, self._stack = [], []
+        self.start = time.perf_counter()
+        self.profiler = None
+
+    def record(self):
+        """Log record for this run."""
+        return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'command': self.command, 'action': self.action,
+                'pid': os.getpid(), 'modes': self.modes, 'total': time.perf_counter() - self.start,
+                'stages': self.stages}
+
+
+class _Stage:
+    """Context manager timing a named stage of the active session."""
+    __slots__ = ('entry',)
+
+    def __init__(self, name, atoms, nbytes):
+        self.entry = {'name': name, 'atoms': atoms, 'bytes': nbytes}
+
+    def __enter__(self):
+        if _session is not None:
+            _session._stack.append(self.entry['name'])
+            self.entry['name'] = '/'.join(_session._stack)
+            self.entry['start'] = time.perf_counter()
+            # Stages are listed in the order they start
+            _session.stages.append(self.entry)
+        return self.entry
+
+    def __exit__(self, *args):
+        if 'start' in self.entry:
+            self.entry['time'] = time.perf_counter() - self.entry.pop('start')
+            for key in ('atoms', 'bytes'):
+                if self.entry[key] is None:
+                    del self.entry[key]
+            if _session is not None:
+                _session._stack.pop()
+        return False
+
+
+def stage(name, atoms=None, nbytes=None):
+    """
+    Time a named stage (with block). The number of atoms and bytes processed can be given here
+    or set on the returned entry (e.g. entry['bytes'] = ...) inside the block.
+    """
+    return _Stage(name, atoms, nbytes)
+
+
+def dumps(result):
+    """JSON text of a plug-in result (timed as the serialize stage, see cjson_io.dumps)."""
+    from cjson_io import dumps as cjson_dumps
+    with stage('serialize') as entry:
+        text = cjson_dumps(result)
+        entry['bytes'] = len(text)
+    return text
+
+
+def enabled():
+    """True if a command is being instrumented."""
+    return _session is not None
+
+
+def debug_modes(debug=False):
+    """Instrumentation modes from the --debug flag and the environment (empty set if off)."""
+    modes = set()
+    for mode in os.environ.get(ENV_VAR, '').split(','):
+        mode = mode.strip().lower()
+        if mode in ('1', 'true', 'yes'):
+            mode = 'timing'
+        if mode in MODES:
+            modes.add(mode)
+    if debug:
+        modes.add('timing')
+    if modes:
+        # Stage timings are always recorded
+        modes.add('timing')
+    return modes
+
+
+def run(command, action, func, *args, modes=None):
+    """Run func(*args) as an instrumented command if any modes are given, logging the results."""
+    global _session
+    if not modes or _session is not None:
+        return func(*args)
+    _session = session = Session(command, action, modes)
+    if 'memory' in modes:
+        import tracemalloc
+        tracemalloc.start()
+    if 'profile' in modes:
+        import cProfile
+        session.profiler = cProfile.Profile()
+        session.profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        _session = None
+        finish(session)
+
+
+def finish(session, log_file=LOG_FILE):
+    """Stop profilers of a session and append its record to the log file."""
+    record = session.record()
+    if session.profiler is not None:
+        session.profiler.disable()
+        record['profile'] = profile_summary(session)
+    if 'memory' in session.modes:
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        record['memory'] = {'current': current, 'peak': peak,
+                            'top': [[str(s.traceback), s.size, s.count]
+                                    for s in snapshot.statistics('lineno')[:TOP_ENTRIES]]}
+    try:
+        with open(log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as error:
+        sys.stderr.write('Could not write debug log %s: %s\n' % (log_file, error))
+
+
+def profile_summary(session):
+    """Save the full profile (.prof, for pstats / snakeviz) and return the most expensive functions."""
+    import pstats
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_file = os.path.join(PROFILE_DIR, '%s-%s-%i.prof' % (session.command, time.strftime('%Y%m%d-%H%M%S'),
+                                                               os.getpid()))
+    session.profiler.dump_stats(profile_file)
+    stats = pstats.Stats(session.profiler)
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_ENTRIES]
+    functions = [['%s:%i(%s)' % func, calls, total, cumulative]
+                 for func, (_, calls, total, cumulative, _) in entries]
+    return {'file': profile_file, 'functions': functions}
+
+
+def read_log(log_file=LOG_FILE):
+    """All records in the debug log."""
+    records = []
+    if os.path.exists(log_file):
+        with open(log_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def print_record(record):
+    """Print stage times of a log record."""
+    print('%s %s %s (%.3f s)' % (record['date'], record['command'], record['action'], record['total']))
+    for entry in record['stages']:
+        counts = ''.join(' %s=%i' % (key, entry[key]) for key in ('atoms', 'bytes') if key in entry)
+        print('  %-40s %9.4f s%s' % (entry['name'], entry['time'], counts))
+    if 'memory' in record:
+        print('  peak memory (traced): %.1f MB' % (record['memory']['peak'] / 1024 ** 2))
+    if 'profile' in record:
+        print('  profile: %s' % record['profile']['file'])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize Nanocar plug-in debug log.')
+    parser.add_argument('--last', '-n', type=int, default=1, help='Number of recent records to show.')
+    parser.add_argument('--log', type=str, default=LOG_FILE, help='Debug log file.')
+    args = vars(parser.parse_args())
+
+    for record in read_log(args['log'])[-args['last']:]:
+        print_record(record)
@@ -7,16 +7,15 @@ Date: November 2018
 """
 import os
 import sys
-from pathlib import Path
 import json
 import argparse
-from angstrom import Molecule
-import numpy as np
-import periodictable
-from lammps_writer import write_data_file, write_input_file
+from nanocar_worker import request
+from instrumentation import stage, run, dumps, debug_modes
 
 
-FF_LIST = ['UFF', 'UFF4MOF', 'DREIDING']
+FF_LIST = ['UFF', 'DREIDING']
+ACCELERATORS = ['none', 'omp', 'gpu', 'intel', 'kokkos']
+DUMP_FORMATS = ['text', 'binary']
 PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -24,14 +23,13 @@ def get_options():
     """Create user interface options."""
     user_options = {}
 
-    surface_info = read_surface_info()
-    user_options['box_x'] = {'label': 'Simulation Box X (nm)',
+    user_options['box_x'] = {'label': 'Simulation Box X (nm, 0 = surface size)',
                               'type': 'float',
-                              'default': surface_info['x'] / 10}
+                              'default': 0.0}
 
-    user_options['box_y'] = {'label': 'Simulation Box Y (nm)',
+    user_options['box_y'] = {'label': 'Simulation Box Y (nm, 0 = surface size)',
                               'type': 'float',
-                              'default': surface_info['y'] / 10}
+                              'default': 0.0}
 
     user_options['box_z'] = {'label': 'Simulation Box Z (nm)',
                               'type': 'float',
@@ -49,23 +47,139 @@ def get_options():
                            'type': 'filePath',
                            'default': PLUGIN_DIR}
 
+    user_options['ff'] = {'label': 'Force field',
+                          'type': 'stringList',
+                          'default': 'UFF',
+                          'values': FF_LIST}
+
+    user_options['place'] = {'label': 'Place nanocar on surface',
+                             'type': 'boolean',
+                             'default': False}
+
+    user_options['n_cars'] = {'label': 'Number of nanocars',
+                              'type': 'integer',
+                              'default': 1,
+                              'minimum': 1}
+
+    user_options['gap'] = {'label': 'Nanocar - surface gap (Å)',
+                           'type': 'float',
+                           'default': 3.0}
+
+    user_options['flexible'] = {'label': 'Flexible nanocar (UFF bonds, angles, dihedrals)',
+                                'type': 'boolean',
+                                'default': False}
+
+    user_options['exclude_surface'] = {'label': 'Exclude surface - surface interactions',
+                                       'type': 'boolean',
+                                       'default': True}
+
+    user_options['skin'] = {'label': 'Neighbor skin (Å, 0 = from timestep)',
+                            'type': 'float',
+                            'default': 0.0}
+
+    user_options['accelerator'] = {'label': 'Accelerator package',
+                                   'type': 'stringList',
+                                   'default': 'none',
+                                   'values': ACCELERATORS}
+
+    user_options['threads'] = {'label': 'Threads (OMP / INTEL)',
+                               'type': 'integer',
+                               'default': 1,
+                               'minimum': 1}
+
+    user_options['restart'] = {'label': 'Restart file every (steps, 0 = off)',
+                               'type': 'integer',
+                               'default': 0,
+                               'minimum': 0,
+                               'maximum': 100000000}
+
+    user_options['dump_format'] = {'label': 'Trajectory format',
+                                   'type': 'stringList',
+                                   'default': 'text',
+                                   'values': DUMP_FORMATS}
+
+    user_options['dump_every'] = {'label': 'Nanocar trajectory every (steps)',
+                                  'type': 'integer',
+                                  'default': 10000,
+                                  'minimum': 1,
+                                  'maximum': 100000000}
+
+    user_options['surface_every'] = {'label': 'Surface trajectory every (steps, 0 = off)',
+                                     'type': 'integer',
+                                     'default': 0,
+                                     'minimum': 0,
+                                     'maximum': 100000000}
+
+    user_options['cache'] = {'label': 'Cache formatted atoms',
+                             'type': 'boolean',
+                             'default': False}
+
     return {'userOptions': user_options }
 
 
-def run_command():
+def run_command(stdinStr=None):
     """Run main function - LAMMPS setup."""
-    stdinStr = sys.stdin.read()
-    opts = json.loads(stdinStr)
+    if stdinStr is None:
+        stdinStr = sys.stdin.read()
+    from cjson_io import loads
+    with stage('parse_input', nbytes=len(stdinStr)):
+        opts = loads(stdinStr)
 
     setup_lammps(opts)
 
 
-def setup_lammps(opts):
-    """Write LAMMPS simulation files."""
+def setup_lammps(opts, scene=None):
+    """
+    Write LAMMPS simulation files.
+    Chassis, wheel and surface atoms are taken from the scene state recorded for the document
+    (see scene_state) unless a scene (list of components) is given. Atoms that are not part of
+    a surface are simulated as the nanocar. Box x and y default to the surface size.
+    """
+    from pathlib import Path
+    from angstrom import Molecule
+    import numpy as np
+    from elements import symbols
+    from lammps_writer import write_data_file, write_input_file, bonded_topology
+    from scene_state import read_scene, component_mask, write_scene_file
     # Read structure information
-    coords = np.array(opts['cjson']['atoms']['coords']['3d'])
-    atoms = [periodictable.elements[i].symbol for i in opts['cjson']['atoms']['elements']['number']]
-    nanocar = Molecule(atoms=atoms, coordinates=np.array(coords).reshape((int(len(coords) / 3)), 3))
+    coords = np.asarray(opts['cjson']['atoms']['coords']['3d'], dtype=float)
+    forcefield = opts.get('ff', 'UFF')
+    numbers, molecule_ids = np.asarray(opts['cjson']['atoms']['elements']['number'], dtype=np.int64), None
+    n_cars = int(opts.get('n_cars', 1))
+    if scene is None:
+        with stage('read_scene'):
+            scene = read_scene(numbers)
+        if scene is None:
+            scene = unknown_scene(opts['cjson'], len(numbers))
+    surfaces = [c for c in scene if c['kind'] == 'surface']
+    surface = component_mask(scene, len(numbers), 'surface')
+    if not opts['box_x'] or not opts['box_y']:
+        if not surfaces:
+            raise ValueError('Simulation box size must be given when there is no metal surface!')
+        opts['box_x'] = opts['box_x'] or surfaces[-1]['x'] / 10
+        opts['box_y'] = opts['box_y'] or surfaces[-1]['y'] / 10
+    arranged = (opts.get('place', False) or n_cars > 1) and surface.any()
+    if not arranged and n_cars > 1:
+        sys.stderr.write('Multiple nanocars need a metal surface! Writing a single nanocar.\n')
+        n_cars = 1
+    with stage('read_bonds', atoms=len(numbers)):
+        # Flexible nanocars need the axle bond of each wheel (recorded in the scene for appended wheels)
+        wheels = [c for c in scene if c['kind'] == 'wheel'] if opts.get('flexible', False) else []
+        bonds, orders = read_bonds(opts['cjson'], surface, n_cars, arranged, wheels)
+    if arranged:
+        with stage('place_on_surface', atoms=len(numbers)):
+            cell = np.diag([surfaces[-1]['x'], surfaces[-1]['y'], 0.0])
+            numbers, coords, molecule_ids = place_on_surface(numbers, coords, surface, cell, opts.get('gap', 3.0),
+                                                             n_cars, forcefield)
+            scene = arrange_scene(scene, surface, n_cars)
+            surface = component_mask(scene, len(numbers), 'surface')
+    if opts.get('flexible', False):
+        with stage('topology', atoms=len(numbers)):
+            topology = bonded_topology(numbers, bonds, orders)
+    else:
+        topology = None
+    with stage('molecule', atoms=len(numbers)):
+        nanocar = Molecule(atoms=symbols(numbers), coordinates=np.array(coords, dtype=float).reshape(-1, 3))
     opts['box_x'], opts['box_y'], opts['box_z'] = opts['box_x'] * 10, opts['box_y'] * 10, opts['box_z'] * 10
     nanocar.set_cell([opts['box_x'], opts['box_y'], opts['box_z'], 90, 90, 90])
     nanocar.center([opts['box_x'] / 2, opts['box_y'] / 2, opts['box_z'] / 2])
@@ -78,32 +192,147 @@ def setup_lammps(opts):
         else:
             opts['dir'] = parent
     data_file = os.path.join(opts['dir'], 'data.nanocar')
-    write_data_file(data_file, nanocar)
+    with stage('write_data_file', atoms=len(numbers)) as entry:
+        write_data_file(data_file, nanocar, cache=opts.get('cache', False), mol_ids=molecule_ids,
+                        forcefield=forcefield, topology=topology, numbers=numbers)
+        entry['bytes'] = os.path.getsize(data_file)
+
+    # Component ids of the written system, used to group atoms in LAMMPS and in trajectory analysis
+    write_scene_file(os.path.join(opts['dir'], 'scene.json'), len(numbers), scene)
 
     # Write input file
-    surface_info = read_surface_info()
-    surface_ids = surface_info['id']
-    surface_atoms = surface_ids[1] - surface_ids[0]
-    num_atoms = len(nanocar.atoms)
-    if surface_ids[0] == 1:
-        mol_ids = [num_atoms - surface_atoms, num_atoms]
-    else:
-        mol_ids = [1, num_atoms - surface_atoms - 1]
     input_file = os.path.join(opts['dir'], 'in.nanocar')
     inp_parameters = {'sim_length': opts['sim_length'], 'ts': opts['timestep'],
-                      'mol_ids': mol_ids, 'surface_ids': surface_ids, 'T': 300}
-    write_input_file(input_file, nanocar, inp_parameters)
+                      'groups': lammps_groups(scene, len(numbers)), 'n_mols': n_cars,
+                      'flexible': topology is not None, 'T': 300}
+    for key in ['exclude_surface', 'skin', 'accelerator', 'threads', 'restart', 'dump_format', 'dump_every',
+                'surface_every']:
+        if key in opts:
+            inp_parameters[key] = opts[key]
+    with stage('write_input_file'):
+        write_input_file(input_file, nanocar, inp_parameters, numbers=numbers)
 
 
-def read_surface_info():
-    """Read surface size for the last metal surface built."""
-    filename = os.path.join(PLUGIN_DIR, 'surface_info.json')
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            surface_info = json.load(f)
-    else:
-        surface_info = {'x': 0.0, 'y': 0.0, 'id': [0, 0]}
-    return surface_info
+def place_on_surface(numbers, coords, surface, cell, gap, n_cars=1, forcefield='UFF'):
+    """
+    Move the nanocar (atoms not in the surface mask) over the surface to a low energy position.
+    If n_cars > 1 copies of the nanocar are tiled over the surface cell without overlapping.
+    Nanocars are written first (molecule ids 1, 2, ...) followed by the surface (molecule id 0).
+    Returns atomic numbers, coordinates and molecule ids.
+    """
+    import numpy as np
+    from surface_placement import place_nanocars
+    numbers, coords = np.asarray(numbers), np.array(coords, dtype=float).reshape(-1, 3)
+    cars, _ = place_nanocars([(numbers[~surface], coords[~surface])] * n_cars, numbers[surface], coords[surface],
+                             cell, gap=gap, forcefield=forcefield)
+    n_car, n_surface = (~surface).sum(), surface.sum()
+    numbers = np.concatenate([np.tile(numbers[~surface], n_cars), numbers[surface]])
+    mol_ids = np.concatenate([np.repeat(np.arange(1, n_cars + 1), n_car), np.zeros(n_surface, dtype=int)])
+    return numbers, np.vstack(cars + [coords[surface]]).reshape(-1), mol_ids
+
+
+def arrange_scene(scene, surface, n_cars=1):
+    """
+    Component ids after place_on_surface: nanocar components are repeated for each copy
+    (with the molecule id of the copy) and surfaces are moved after the nanocars.
+    """
+    import numpy as np
+    car_ids, surface_ids = np.cumsum(~surface), np.cumsum(surface) + n_cars * (~surface).sum()
+    arranged = []
+    for c in scene:
+        first, last = c['id'][0] - 1, c['id'][1] - 1
+        if c['kind'] == 'surface':
+            arranged.append(dict(c, id=[int(surface_ids[first]), int(surface_ids[last])]))
+            continue
+        for k in range(n_cars):
+            shift = k * int((~surface).sum())
+            arranged.append(dict(c, id=[int(car_ids[first]) + shift, int(car_ids[last]) + shift], mol=k + 1))
+            for key in ('site', 'anchor'):
+                if key in c:
+                    arranged[-1][key] = int(car_ids[c[key] - 1]) + shift
+    return sorted(arranged, key=lambda c: c['id'][0])
+
+
+def lammps_groups(scene, n_atoms):
+    """
+    LAMMPS group id ranges: mol (all atoms not in a surface), surf and, if there are wheels,
+    chassis (nanocar atoms that are not wheels) and wheels.
+    """
+    from scene_state import component_mask, id_ranges
+    surface = component_mask(scene, n_atoms, 'surface')
+    groups = {'mol': id_ranges(~surface), 'surf': id_ranges(surface)}
+    wheels = component_mask(scene, n_atoms, 'wheel')
+    if wheels.any():
+        groups['chassis'] = id_ranges(~surface & ~wheels)
+        groups['wheels'] = id_ranges(wheels)
+    return groups
+
+
+def unknown_scene(cjson, n_atoms):
+    """
+    Scene for a document without recorded scene state (see scene_state). Atoms without any bond (e.g. a metal
+    surface) cannot be told apart from the nanocar, so they raise ValueError instead of being simulated as
+    part of the rigid nanocar. Otherwise all atoms are the nanocar (with a warning).
+    """
+    import numpy as np
+    bonds = np.asarray(cjson.get('bonds', {}).get('connections', {}).get('index', []), dtype=np.int64)
+    bonded = np.zeros(n_atoms, dtype=bool)
+    bonded[bonds] = True
+    if not bonded.all():
+        raise ValueError('No Nanocar scene for this document (atoms changed after the last Nanocar action or '
+                         'built with an older version) and %i atoms are not bonded (e.g. a metal surface). '
+                         'Delete the surface and add it again with Metal Surface.' % (~bonded).sum())
+    sys.stderr.write('No Nanocar scene for this document, all %i atoms are simulated as the nanocar.\n' % n_atoms)
+    return []
+
+
+def read_bonds(cjson, surface, n_cars=1, arranged=False, wheels=()):
+    """
+    Bonds (0-based atom pairs) and bond orders between nanocar atoms, bonds to surface atoms are ignored.
+    Axle bonds of wheels (scene components) that are not bonded to their chassis site are added from the
+    anchor atom recorded in the scene, a wheel with neither raises ValueError.
+    If the nanocars are arranged by place_on_surface, bonds are re-indexed and repeated for each nanocar.
+    """
+    import numpy as np
+    bonds = np.asarray(cjson.get('bonds', {}).get('connections', {}).get('index', []), dtype=np.int64).reshape(-1, 2)
+    orders = np.asarray(cjson.get('bonds', {}).get('order', np.ones(len(bonds))), dtype=np.int64)
+    car_bonds = ~surface[bonds].any(axis=1)
+    bonds, orders = bonds[car_bonds], orders[car_bonds]
+    axles = axle_bonds(wheels, bonds)
+    bonds, orders = np.vstack([bonds, axles]), np.concatenate([orders, np.ones(len(axles), dtype=np.int64)])
+    if arranged:
+        # Nanocar atoms keep their order and are followed by the copies
+        car_index = np.cumsum(~surface) - 1
+        n_car = (~surface).sum()
+        bonds = (car_index[bonds][None] + n_car * np.arange(n_cars)[:, None, None]).reshape(-1, 2)
+        orders = np.tile(orders, n_cars)
+    return bonds, orders
+
+
+def axle_bonds(wheels, bonds):
+    """
+    Bonds (0-based atom pairs) between wheels (scene components) and their chassis site that are missing
+    from bonds, e.g. for wheels appended by Connect Wheel. Interlocked wheels are not bonded to their site.
+    Raises ValueError for a wheel that is not bonded to its site and has no anchor atom recorded
+    (scenes written before anchors were recorded).
+    """
+    import numpy as np
+    missing, unbonded = [], []
+    for wheel in wheels:
+        if 'site' not in wheel or wheel.get('interlocked', False):
+            continue
+        site, (first, last) = wheel['site'] - 1, wheel['id']
+        other = np.where(bonds[:, 0] == site, bonds[:, 1], np.where(bonds[:, 1] == site, bonds[:, 0], -1))
+        if ((other >= first - 1) & (other <= last - 1)).any():
+            continue
+        if 'anchor' in wheel:
+            missing.append([site, wheel['anchor'] - 1])
+        else:
+            unbonded.append('%s (atoms %i-%i, site %i)' % (wheel['name'], first, last, wheel['site']))
+    if unbonded:
+        raise ValueError('Wheels not bonded to the chassis: %s. Bond them to their site atom or connect them again '
+                         'with Connect Wheel for a flexible nanocar.' % ', '.join(unbonded))
+    return np.array(missing, dtype=np.int64).reshape(-1, 2)
 
 
 if __name__ == "__main__":
@@ -116,13 +345,18 @@ if __name__ == "__main__":
     parser.add_argument('--lang', nargs='?', default='en')
     args = vars(parser.parse_args())
 
-    debug = args['debug']
+    debug = debug_modes(args['debug'])
 
     if args['display_name']:
         print("LAMMPS setup")
     if args['menu_path']:
         print("&Build|Nanocar")
     if args['print_options']:
-        print(json.dumps(get_options()))
+        reply = request('lammps_setup', 'print_options')
+        print(reply if reply is not None else json.dumps(get_options()))
     elif args['run_command']:
-        print(json.dumps(run_command()))
+        stdinStr = sys.stdin.read()
+        reply = request('lammps_setup', 'run_command', stdinStr, debug=debug)
+        if reply is None:
+            reply = run('lammps_setup', 'run_command', lambda: dumps(run_command(stdinStr)), modes=debug)
+        print(reply)
@@ -5,83 +5,332 @@ Author: Kutay B. Sezginel
 Date: November 2018
 """
 import os
-import csv
-import periodictable
+import gzip
+import shutil
+import hashlib
+import numpy as np
+from forcefield import pair_coefficients
+from elements import symbols, masses, atomic_numbers
+from instrumentation import stage
 
 
-CSV_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'uff_nonbonded.csv')
+ATOMS_CACHE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '.atoms_cache')
+# Least recently used Atoms sections are evicted beyond this many files or total size
+ATOMS_CACHE_ENTRIES = 16
+ATOMS_CACHE_BYTES = 512 * 1024 ** 2
+ATOM_LINE = '%10i   %3i   %3i   %5.5f  %12.5f  %12.5f  %12.5f\n'
+RESTART_FILE = 'restart.nanocar'
+# Dump format -> (nanocar trajectory, surface trajectory, element or type column)
+DUMP_FILES = {'text': ('traj.xyz', 'surface.xyz', 'element'),
+              'binary': ('traj.bin', 'surface.bin', 'type')}
+# Accelerator -> (package command with number of threads, suffix)
+ACCELERATORS = {'omp': ('omp %(threads)i', 'omp'),
+                'gpu': ('gpu 1', 'gpu'),
+                'intel': ('intel 0 omp %(threads)i', 'intel'),
+                'kokkos': ('kokkos', 'kk')}
+INPUT_DEFAULTS = {'n_mols': 1, 'flexible': False, 'skin': 0.0, 'exclude_surface': True,
+                  'accelerator': 'none', 'threads': 1, 'restart': 0,
+                  'dump_format': 'text', 'dump_every': 10000, 'surface_every': 0}
+# Bonded sections: name, atoms per interaction, coefficient format
+TOPOLOGY_SECTIONS = [('bonds', 'Bonds', 'Bond', 2, '%12.5f %12.5f'),
+                     ('angles', 'Angles', 'Angle', 3, '%12.5f %12.5f'),
+                     ('dihedrals', 'Dihedrals', 'Dihedral', 4, '%12.5f %3i %3i')]
+CHUNK_SIZE = 50000
 
 
-def write_data_file(data_file, molecule):
-    """Write LAMMPS data file"""
+def write_data_file(data_file, molecule, cache=False, mol_ids=None, forcefield='UFF', topology=None, numbers=None):
+    """
+    Write LAMMPS data file.
+    Atomic numbers of the atoms can be given (numbers), otherwise they are looked up from the molecule atoms.
+    Molecule ids can be given for each atom (e.g. one id per nanocar), by default all atoms are in molecule 0.
+    Bonds, angles and dihedrals are written if a topology is given (see bonded_topology).
+    LJ coefficients for all pairs of atom types are written explicitly (arithmetic mixing).
+    The Atoms section is formatted in chunks of CHUNK_SIZE atoms to keep memory bounded.
+    If cache is True the formatted Atoms section is also stored as a compressed sidecar
+    (keyed by its contents) so repeated setups of the same system skip formatting.
+    """
     q = 0
     mol_id = 0
-    unique_atoms = sorted(list(set(molecule.atoms)))
-    uff_par = read_uff_parameters(CSV_FILE, unique_atoms)
-    atom_types = {}
+    numbers = atomic_numbers(molecule.atoms) if numbers is None else np.asarray(numbers, dtype=np.int64)
+    type_numbers, atom_types = element_types(numbers)
+    unique_atoms = symbols(type_numbers)
+    with stage('pair_coefficients'):
+        pair_eps, pair_sig = pair_coefficients(type_numbers, forcefield)
     with open(data_file, 'w') as f:
         f.write('Created by Avogadro Nanocar Builder\n\n')
-        f.write('%10i atoms\n' % len(molecule.atoms))
-        f.write('%10i bonds\n' % 0)
-        f.write('%10i angles\n' % 0)
-        f.write('%10i dihedrals\n' % 0)
+        f.write('%10i atoms\n' % len(numbers))
+        topology = {} if topology is None else topology
+        empty = (np.zeros((0, 1), dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3)))
+        for key, _, _, _, _ in TOPOLOGY_SECTIONS:
+            f.write('%10i %s\n' % (len(topology.get(key, empty)[0]), key))
         f.write('%10i impropers\n\n' % 0)
-        f.write('%10i atom types\n\n' % len(unique_atoms))
+        f.write('%10i atom types\n' % len(unique_atoms))
+        for key, _, name, _, _ in TOPOLOGY_SECTIONS:
+            if key in topology:
+                f.write('%10i %s types\n' % (len(topology[key][2]), name.lower()))
+        f.write('\n')
         f.write('%16.5f   %5.5f   xlo xhi\n' % (0.0, molecule.cell.a))
         f.write('%16.5f   %5.5f   ylo yhi\n' % (0.0, molecule.cell.b))
         f.write('%16.5f   %5.5f   zlo zhi\n\n' % (0.0, molecule.cell.c))
         f.write('Masses\n\n')
-        for idx, atom in enumerate(unique_atoms, start=1):
-            atom_types[atom] = idx
-            f.write('%5i   %10.5f # %s\n' % (idx, periodictable.elements.symbol(atom).mass, atom))
-        f.write('\nPair Coeffs\n\n')
-        for idx, atom in enumerate(unique_atoms, start=1):
-            f.write('%5i   %8.5f   %8.5f # %s\n' % (idx, uff_par[atom]['eps'], uff_par[atom]['sig'], atom))
+        for idx, (mass, atom) in enumerate(zip(masses(type_numbers), unique_atoms), start=1):
+            f.write('%5i   %10.5f # %s\n' % (idx, mass, atom))
+        f.write('\nPairIJ Coeffs\n\n')
+        for i, j in zip(*np.triu_indices(len(unique_atoms))):
+            f.write('%5i %5i   %8.5f   %8.5f # %s-%s\n'
+                    % (i + 1, j + 1, pair_eps[i, j], pair_sig[i, j], unique_atoms[i], unique_atoms[j]))
+        for key, _, name, _, coeff_line in TOPOLOGY_SECTIONS:
+            if key in topology:
+                f.write('\n%s Coeffs\n\n' % name)
+                for idx, coeffs in enumerate(topology[key][2], start=1):
+                    f.write(('%5i   ' + coeff_line + '\n') % tuple([idx] + coeffs.tolist()))
         f.write('\nAtoms\n\n')
-        for idx, (atom, coor) in enumerate(zip(molecule.atoms, molecule.coordinates), start=1):
-            f.write('%10i   %3i   %3i   %5.5f  %12.5f  %12.5f  %12.5f\n' % (idx, mol_id, atom_types[atom], q, coor[0], coor[1], coor[2]))
+        f.flush()
+        mol_ids = np.full(len(atom_types), mol_id) if mol_ids is None else np.asarray(mol_ids)
+        charges = np.full(len(atom_types), q, dtype=float)
+        with stage('atoms', atoms=len(atom_types)) as entry:
+            start = f.tell()
+            write_atoms(f, atom_types, mol_ids, charges, molecule.coordinates, cache=cache)
+            entry['bytes'] = f.tell() - start
+        for key, section, _, n_atoms, _ in TOPOLOGY_SECTIONS:
+            if key in topology:
+                with stage(key) as entry:
+                    start = f.tell()
+                    f.write('\n%s\n\n' % section)
+                    atoms, types, _ = topology[key]
+                    for chunk in format_topology_chunks(atoms, types):
+                        f.write(chunk)
+                    entry['bytes'] = f.tell() - start
 
 
-def write_input_file(input_file, molecule, parameters):
-    """Write LAMMPS input file"""
-    write_every = 10000
-    num_timesteps = int(parameters['sim_length'] / parameters['ts'] * 1e6)
-    mol_ids, surface_ids = parameters['mol_ids'], parameters['surface_ids']
-    atom_names = sorted(list(set(molecule.atoms)))
+def element_types(numbers):
+    """
+    Atom types for atomic numbers, one type per element in alphabetical order of the symbols.
+    Returns the atomic number of each type and the type (1-based) of each atom.
+    """
+    unique, inverse = np.unique(numbers, return_inverse=True)
+    order = np.argsort(symbols(unique), kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return unique[order], rank[inverse.reshape(-1)] + 1
+
+
+def write_atoms(f, atom_types, mol_ids, charges, coordinates, cache=False):
+    """Write Atoms section rows to an open file, optionally reusing a cached copy."""
+    coordinates = np.asarray(coordinates, dtype=float)
+    cache_file = None
+    if cache:
+        key = hashlib.sha1()
+        for array in (atom_types.astype(np.int64), mol_ids.astype(np.int64), charges, coordinates):
+            key.update(np.ascontiguousarray(array).tobytes())
+        cache_file = os.path.join(ATOMS_CACHE_DIR, '%s.gz' % key.hexdigest())
+        if os.path.exists(cache_file):
+            with gzip.open(cache_file, 'rt') as cached:
+                shutil.copyfileobj(cached, f, 1 << 20)
+            # Mark as recently used
+            os.utime(cache_file)
+            return
+        os.makedirs(ATOMS_CACHE_DIR, exist_ok=True)
+        tmp_file = '%s.%i.tmp' % (cache_file, os.getpid())
+        sidecar = gzip.open(tmp_file, 'wt', compresslevel=1)
+
+    for chunk in format_atom_chunks([(atom_types, mol_ids, charges, coordinates)]):
+        f.write(chunk)
+        if cache_file is not None:
+            sidecar.write(chunk)
+
+    if cache_file is not None:
+        from slab_cache import evict
+        sidecar.close()
+        os.replace(tmp_file, cache_file)
+        evict(ATOMS_CACHE_DIR, ATOMS_CACHE_ENTRIES, ATOMS_CACHE_BYTES, suffix='.gz')
+
+
+def format_atom_chunks(chunks, first_id=1):
+    """
+    Format Atoms section rows from an iterable of (atom_types, mol_ids, charges, coordinates) chunks.
+    Scalar types, molecule ids and charges are broadcast over the chunk coordinates, so atoms can be
+    streamed from a generator (e.g. slab_lattice.SlabLattice.iter_positions) with bounded memory.
+    Yields formatted text of at most CHUNK_SIZE rows.
+    """
+    atom_id = first_id
+    for atom_types, mol_ids, charges, coordinates in chunks:
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+        n_atoms = len(coordinates)
+        atom_types = np.broadcast_to(atom_types, n_atoms)
+        mol_ids, charges = np.broadcast_to(mol_ids, n_atoms), np.broadcast_to(charges, n_atoms)
+        for start in range(0, n_atoms, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, n_atoms)
+            rows = np.empty((end - start, 7))
+            rows[:, 0] = np.arange(atom_id + start, atom_id + end)
+            rows[:, 1] = mol_ids[start:end]
+            rows[:, 2] = atom_types[start:end]
+            rows[:, 3] = charges[start:end]
+            rows[:, 4:] = coordinates[start:end]
+            yield (ATOM_LINE * (end - start)) % tuple(rows.ravel().tolist())
+        atom_id += n_atoms
+
+
+def format_topology_chunks(atoms, types):
+    """Format Bonds / Angles / Dihedrals rows (id, type, atom ids) in chunks of CHUNK_SIZE rows."""
+    line = '%10i %5i' + ' %10i' * atoms.shape[1] + '\n'
+    for start in range(0, len(atoms), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, len(atoms))
+        rows = np.column_stack([np.arange(start + 1, end + 1), types[start:end], atoms[start:end] + 1])
+        yield (line * (end - start)) % tuple(rows.ravel().tolist())
+
+
+def bonded_topology(numbers, bonds, orders=None):
+    """
+    Bonds, angles and dihedrals with UFF parameters for the given bonds (0-based atom index pairs).
+    Angles and dihedrals are enumerated from the adjacency index, interactions with the same
+    parameters share a type. Returns {section: (atom indices, type ids starting at 1, type coefficients)}.
+    """
+    from topology import build_adjacency, degree, angles, dihedrals
+    from forcefield import uff_atom_types, bond_parameters, angle_parameters, dihedral_parameters
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    offsets, neighbors = build_adjacency(bonds, len(numbers))
+    bonded = np.unique(bonds)
+    types = np.full(len(numbers), -1, dtype=np.int64)
+    types[bonded] = uff_atom_types(np.asarray(numbers)[bonded], degree(offsets, bonded))
+
+    topology = {}
+    angle_atoms, dihedral_atoms = angles(offsets, neighbors), dihedrals(offsets, neighbors, bonds)
+    dihedral_coeffs = dihedral_parameters(types, dihedral_atoms)
+    # Torsions without a barrier (around sp atoms) are left out
+    barrier = dihedral_coeffs[:, 0] > 0
+    for key, atoms, coeffs in [('bonds', bonds, bond_parameters(types, bonds, orders)),
+                               ('angles', angle_atoms, angle_parameters(types, angle_atoms)),
+                               ('dihedrals', dihedral_atoms[barrier], dihedral_coeffs[barrier])]:
+        if len(atoms) > 0:
+            unique, inverse = np.unique(np.round(coeffs, 5), axis=0, return_inverse=True)
+            topology[key] = (atoms, inverse.reshape(-1) + 1, unique)
+    return topology
+
+
+def write_input_file(input_file, molecule, parameters, numbers=None):
+    """
+    Write LAMMPS input file.
+    Atomic numbers of the atoms can be given (numbers), otherwise they are looked up from the molecule atoms.
+    Atom groups are given as id ranges (parameters['groups']: name -> [[first, last], ...]) and must
+    include the nanocar (mol) and surface (surf) groups.
+    If restart files are written (parameters['restart'] > 0) a resume input file (input_file + '.resume')
+    is also written which continues the run from the last restart file up to the same final timestep.
+    """
+    parameters = dict(INPUT_DEFAULTS, **parameters)
+    numbers = atomic_numbers(molecule.atoms) if numbers is None else numbers
+    parameters['atom_names'] = symbols(element_types(numbers)[0]).tolist()
+    parameters['n_steps'] = int(parameters['sim_length'] / parameters['ts'] * 1e6)
+    if not parameters['skin']:
+        parameters['skin'] = neighbor_skin(parameters['ts'])
     with open(input_file, 'w') as f:
-        f.write('log             log.nanocar append\n')
-        f.write('units           real\n')
-        f.write('atom_style      full\n')
-        f.write('boundary        p p p\n')
-        f.write('pair_style      lj/cut 12.500\n')
-        f.write('pair_modify     tail yes mix arithmetic\n')
+        write_input_header(f, parameters)
         f.write('read_data       data.nanocar\n\n')
-        f.write('group           mol      id   %i:%i\n' % (mol_ids[0], mol_ids[1]))
-        f.write('group           surf     id   %i:%i\n' % (surface_ids[0], surface_ids[1]))
-        f.write('compute         C1 mol com\n')
-        f.write('variable        seed equal 123456\n')
-        f.write('variable        T equal %i\n'% parameters['T'])
-        f.write('thermo          %i\n' % write_every)
-        f.write('thermo_style    custom step temp press etotal epair emol c_C1[1] c_C1[2] c_C1[3]\n')
+        for name, ranges in parameters['groups'].items():
+            write_group(f, name, ranges)
+        write_input_settings(f, parameters)
         f.write('velocity        mol create $T ${seed} dist uniform\n')
-        f.write('timestep        %.1f\n' % parameters['ts'])
-        f.write('variable        txyz equal %i\n' % write_every)
-        f.write('dump            1 mol custom ${txyz} traj.xyz id element xu yu zu\n')
-        f.write('dump_modify     1 element %s\n\n' % ' '.join(atom_names))
-        f.write('fix             RIG mol rigid/nvt single temp $T $T 100\n')
-        f.write('run             %i\n' % num_timesteps)
-        f.write('unfix           RIG\n')
-
-
-def read_uff_parameters(csv_file, atoms, skip_headers=True):
-    rm_to_sigma = 1 / (2 ** (1/6))
-    with open(csv_file, 'r') as f:
-        csv_reader = csv.reader(f, delimiter=',')
-        if skip_headers:
-            next(csv_reader, None)
-        parameters = {}
-        for row in csv_reader:
-            if row[0] in atoms:
-                parameters[row[0]] = {'eps': float(row[2]),
-                                      'sig': float(row[1]) * rm_to_sigma}
-    return parameters
+        write_input_run(f, parameters, 'run             %i\n' % parameters['n_steps'])
+    if parameters['restart'] > 0:
+        with open(input_file + '.resume', 'w') as f:
+            write_input_header(f, parameters, resume=True)
+            f.write('read_restart    %s\n\n' % RESTART_FILE)
+            write_input_settings(f, parameters, resume=True)
+            write_input_run(f, parameters, 'run             %i upto\n' % parameters['n_steps'])
+
+
+def write_group(f, name, ranges):
+    """Group of atoms from id ranges ([first, last])."""
+    if ranges:
+        f.write('group           %-8s id   %s\n' % (name, ' '.join('%i:%i' % tuple(r) for r in ranges)))
+    else:
+        f.write('group           %-8s empty\n' % name)
+
+
+def write_input_header(f, parameters, resume=False):
+    """Log file, accelerator package and (except when reading a restart file) force field styles."""
+    f.write('log             log.nanocar append\n')
+    accelerator = parameters['accelerator']
+    if accelerator != 'none':
+        package, suffix = ACCELERATORS[accelerator]
+        f.write('package         %s\n' % (package % parameters))
+        f.write('suffix          %s\n' % suffix)
+    if resume:
+        # Units, styles, coefficients and groups are stored in the restart file
+        return
+    f.write('units           real\n')
+    f.write('atom_style      full\n')
+    f.write('boundary        p p p\n')
+    f.write('pair_style      lj/cut 12.500\n')
+    f.write('pair_modify     tail yes mix arithmetic\n')
+    if parameters['flexible']:
+        f.write('bond_style      harmonic\n')
+        f.write('angle_style     harmonic\n')
+        f.write('dihedral_style  harmonic\n')
+        f.write('special_bonds   lj/coul 0.0 0.0 1.0\n')
+
+
+def write_input_settings(f, parameters, resume=False):
+    """Neighbor lists, computes, output and integration fixes (not stored in restart files)."""
+    write_every = 10000
+    n_mols = parameters['n_mols']
+    f.write('neighbor        %.2f bin\n' % parameters['skin'])
+    f.write('neigh_modify    delay 0 every 1 check yes\n')
+    if parameters['exclude_surface']:
+        # Surface atoms are not integrated, their pair interactions are never needed
+        f.write('neigh_modify    exclude group surf surf\n')
+    f.write('compute         C1 mol com\n')
+    if n_mols > 1:
+        # Center of mass of each nanocar (molecule id) written to a separate file
+        f.write('compute         MOL mol chunk/atom molecule\n')
+        f.write('compute         C2 mol com/chunk MOL\n')
+    f.write('variable        seed equal 123456\n')
+    f.write('variable        T equal %i\n' % parameters['T'])
+    f.write('thermo          %i\n' % write_every)
+    f.write('thermo_style    custom step temp press etotal epair emol c_C1[1] c_C1[2] c_C1[3]\n')
+    f.write('timestep        %.1f\n' % parameters['ts'])
+    f.write('variable        txyz equal %i\n' % parameters['dump_every'])
+    if n_mols > 1:
+        f.write('fix             COM mol ave/time ${txyz} 1 ${txyz} c_C2[*] %s com.nanocar mode vector\n'
+                % ('append' if resume else 'file'))
+    traj_file, surface_file, atom_column = DUMP_FILES[parameters['dump_format']]
+    columns = 'id mol %s' % atom_column if n_mols > 1 else 'id %s' % atom_column
+    f.write('dump            1 mol custom ${txyz} %s %s xu yu zu\n' % (traj_file, columns))
+    write_dump_modify(f, 1, parameters, resume)
+    if parameters['surface_every'] > 0:
+        # Surface atoms are written separately and less often than the nanocar
+        f.write('dump            2 surf custom %i %s id %s x y z\n'
+                % (parameters['surface_every'], surface_file, atom_column))
+        write_dump_modify(f, 2, parameters, resume)
+    if parameters['restart'] > 0:
+        f.write('restart         %i %s\n' % (parameters['restart'], RESTART_FILE))
+    f.write('\n')
+
+
+def write_dump_modify(f, dump_id, parameters, resume=False):
+    """Element names for text dumps and appending to existing dump files on resume."""
+    options = ''
+    if parameters['dump_format'] == 'text':
+        options += ' element %s' % ' '.join(parameters['atom_names'])
+    if resume:
+        options += ' append yes'
+    if options:
+        f.write('dump_modify     %i%s\n' % (dump_id, options))
+
+
+def write_input_run(f, parameters, run_line):
+    """Integration fix, run command and final restart file."""
+    if parameters['flexible']:
+        f.write('fix             NVT mol nvt temp $T $T 100\n')
+    else:
+        f.write('fix             RIG mol rigid/nvt %s temp $T $T 100\n'
+                % ('molecule' if parameters['n_mols'] > 1 else 'single'))
+    f.write(run_line)
+    if parameters['restart'] > 0:
+        f.write('write_restart   %s\n' % RESTART_FILE)
+    f.write('unfix           %s\n' % ('NVT' if parameters['flexible'] else 'RIG'))
+
+
+def neighbor_skin(timestep):
+    """Neighbor list skin (Å) for a timestep (fs): 2 Å (LAMMPS default for real units) at 1 fs, within 1 - 4 Å."""
+    return min(max(1.0 + timestep, 1.0), 4.0)
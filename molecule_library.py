@@ -0,0 +1,236 @@
+"""
+Compiled molecule library for Nanocar wheels and chassis.
+All xyz files in a directory are parsed once and stored in a single .npz file
+(element numbers, coordinates, bonds, connection/alignment sites and alignment vectors).
+Rigid body descriptors are stored with each molecule: centroid, inertia tensor, principal axes
+and radius, and for wheels (molecules with Xc and Xa sites) the rotation matrices about the axle
+(the alignment vector) in ROTATION_STEPS steps, so wheels can be spun without building rotations.
+The library is rebuilt only when a source file is added, removed or modified.
+"""
+import os
+import hashlib
+import numpy as np
+from elements import atomic_numbers, covalent_radii, masses
+
+
+LIBRARY_FILE = '.library.npz'
+LIBRARY_VERSION = 4
+# Number of axle rotations stored for each wheel (1 degree steps)
+ROTATION_STEPS = 360
+# Descriptor -> shape for one molecule
+DESCRIPTOR_SHAPES = {'centroid': (3,), 'inertia': (3, 3), 'principal_moments': (3,), 'principal_axes': (3, 3),
+                     'radius': (), 'axle_rotations': (ROTATION_STEPS, 3, 3)}
+DUMMY_ATOMS = {'Xc': 0, 'Xa': 0}
+BOND_TOLERANCE = 0.45
+# A real atom this close to Xa (Å) is bonded to the chassis, wheels without one are interlocked
+ANCHOR_TOLERANCE = 0.5
+
+# In-process cache of loaded libraries: directory -> library
+_libraries = {}
+
+
+def list_molecules(directory):
+    """List names of molecules (xyz files) in a directory."""
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith('.xyz'))
+
+
+def load_library(directory):
+    """Load compiled library for a directory, rebuilding it if any of the xyz files changed."""
+    names = list_molecules(directory)
+    sources = [os.path.join(directory, '%s.xyz' % name) for name in names]
+    mtimes = np.array([os.path.getmtime(src) for src in sources])
+
+    cached = _libraries.get(directory)
+    if cached is not None and cached['names'].tolist() == names and np.array_equal(cached['mtimes'], mtimes):
+        return cached
+
+    library_file = os.path.join(directory, LIBRARY_FILE)
+    library = None
+    if os.path.exists(library_file):
+        with np.load(library_file) as npz:
+            library = dict(npz)
+        if int(library.get('version', 0)) != LIBRARY_VERSION or library['names'].tolist() != names:
+            library = None
+        elif not np.array_equal(library['mtimes'], mtimes):
+            # Touched files are only rebuilt if their contents changed
+            if [file_hash(src) for src in sources] == library['hashes'].tolist():
+                library['mtimes'] = mtimes
+                save_library(library_file, library)
+            else:
+                library = None
+
+    if library is None:
+        library = compile_library(sources, names, mtimes)
+        save_library(library_file, library)
+
+    _libraries[directory] = library
+    return library
+
+
+def compile_library(sources, names, mtimes):
+    """Parse xyz files and pack them into flat arrays."""
+    symbols, coords, offsets = [], [], [0]
+    bonds, bond_offsets = [], [0]
+    connection, alignment, anchor = [], [], []
+    for src in sources:
+        mol_symbols, mol_coords = read_xyz(src)
+        mol_bonds = perceive_bonds(element_numbers(mol_symbols), mol_coords)
+        connection.append(_site_index(mol_symbols, 'Xc'))
+        alignment.append(_site_index(mol_symbols, 'Xa'))
+        anchor.append(_anchor_index(mol_symbols, mol_coords, alignment[-1]))
+        symbols.append(mol_symbols)
+        coords.append(mol_coords)
+        bonds.append(mol_bonds)
+        offsets.append(offsets[-1] + len(mol_symbols))
+        bond_offsets.append(bond_offsets[-1] + len(mol_bonds))
+
+    symbols = np.concatenate(symbols) if symbols else np.array([], dtype='U3')
+    coords = np.concatenate(coords) if coords else np.zeros((0, 3))
+    bonds = np.concatenate(bonds) if bonds else np.zeros((0, 2), dtype=np.int64)
+    offsets, bond_offsets = np.array(offsets, dtype=np.int64), np.array(bond_offsets, dtype=np.int64)
+    connection, alignment = np.array(connection, dtype=np.int64), np.array(alignment, dtype=np.int64)
+
+    # Unit vector from connection site (Xc) to alignment site (Xa) for molecules that have both
+    vectors = np.full((len(names), 3), np.nan)
+    has_sites = (connection >= 0) & (alignment >= 0)
+    v = coords[offsets[:-1] + alignment] - coords[offsets[:-1] + connection]
+    vectors[has_sites] = v[has_sites] / np.linalg.norm(v[has_sites], axis=1)[:, None]
+
+    numbers = element_numbers(symbols)
+    descriptors = [molecule_descriptors(numbers[start:end], coords[start:end], vectors[idx],
+                                        coords[start + alignment[idx]] if has_sites[idx] else None)
+                   for idx, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]))]
+    descriptors = {key: np.array([d[key] for d in descriptors]).reshape((len(names),) + shape)
+                   for key, shape in DESCRIPTOR_SHAPES.items()}
+
+    library = {'version': LIBRARY_VERSION, 'names': np.array(names, dtype=str), 'mtimes': mtimes,
+               'hashes': np.array([file_hash(src) for src in sources], dtype=str),
+               'offsets': offsets, 'symbols': symbols, 'numbers': numbers,
+               'coordinates': coords, 'bonds': bonds, 'bond_offsets': bond_offsets,
+               'connection_site': connection, 'alignment_site': alignment,
+               'anchor_site': np.array(anchor, dtype=np.int64), 'alignment_vector': vectors}
+    library.update(descriptors)
+    return library
+
+
+def molecule_descriptors(numbers, coords, axle=None, pivot=None):
+    """
+    Rigid body descriptors of a molecule (dummy atoms are left out): centroid, mass weighted inertia
+    tensor about the centroid with its principal moments and axes (columns, ascending moments) and radius.
+    For wheels the axle (unit vector) and a point on it (pivot) are given: the radius is then measured
+    from the axle and axle_rotations holds ROTATION_STEPS rotations about it (NaN for other molecules).
+    """
+    real = numbers > 0
+    points, weights = coords[real], masses(numbers[real])
+    centroid = points.mean(axis=0) if len(points) > 0 else np.zeros(3)
+    r = points - centroid
+    inertia = np.eye(3) * (weights * (r * r).sum(axis=1)).sum() - np.einsum('n,ni,nj->ij', weights, r, r)
+    moments, axes = np.linalg.eigh(inertia)
+    rotations = np.full((ROTATION_STEPS, 3, 3), np.nan)
+    if axle is not None and pivot is not None:
+        radial = points - pivot
+        radial -= np.outer(radial @ axle, axle)
+        rotations = axis_rotations(axle, 2 * np.pi * np.arange(ROTATION_STEPS) / ROTATION_STEPS)
+    else:
+        radial = r
+    radius = np.linalg.norm(radial, axis=1).max() if len(points) > 0 else 0.0
+    return {'centroid': centroid, 'inertia': inertia, 'principal_moments': moments, 'principal_axes': axes,
+            'radius': radius, 'axle_rotations': rotations}
+
+
+def axle_rotations(stored, axle, steps):
+    """
+    Rotations about a wheel axle in the given number of equal steps, shape (steps, 3, 3).
+    Taken from the rotations stored in the library (stored) if steps divides ROTATION_STEPS.
+    """
+    steps = max(int(steps), 1)
+    if ROTATION_STEPS % steps == 0:
+        return stored[::ROTATION_STEPS // steps]
+    return axis_rotations(axle, 2 * np.pi * np.arange(steps) / steps)
+
+
+def axis_rotations(axis, angles):
+    """Rotation matrices about a unit axis for each angle (Rodrigues' formula), shape (n_angles, 3, 3)."""
+    k = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    sin, cos = np.sin(angles)[:, None, None], np.cos(angles)[:, None, None]
+    return np.eye(3) + sin * k + (1 - cos) * k @ k
+
+
+def save_library(library_file, library):
+    """Write library atomically, silently skipping read-only plug-in directories."""
+    tmp_file = '%s.%i.tmp.npz' % (library_file[:-4], os.getpid())
+    try:
+        np.savez(tmp_file, **library)
+        os.replace(tmp_file, library_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_molecule(library, name):
+    """Get a single molecule from a library."""
+    idx, = np.where(library['names'] == name)[0]
+    start, end = library['offsets'][idx], library['offsets'][idx + 1]
+    bond_start, bond_end = library['bond_offsets'][idx], library['bond_offsets'][idx + 1]
+    return {'name': name,
+            'atoms': library['symbols'][start:end],
+            'numbers': library['numbers'][start:end],
+            'coordinates': library['coordinates'][start:end].copy(),
+            'bonds': library['bonds'][bond_start:bond_end],
+            'connection_site': int(library['connection_site'][idx]),
+            'alignment_site': int(library['alignment_site'][idx]),
+            'anchor_site': int(library['anchor_site'][idx]),
+            'alignment_vector': library['alignment_vector'][idx],
+            **{key: library[key][idx] for key in DESCRIPTOR_SHAPES}}
+
+
+def read_xyz(filename):
+    """Read atom symbols and coordinates from xyz file."""
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    n_atoms = int(lines[0])
+    rows = [line.split() for line in lines[2:2 + n_atoms]]
+    symbols = np.array([row[0] for row in rows], dtype='U3')
+    coords = np.array([row[1:4] for row in rows], dtype=float).reshape(-1, 3)
+    return symbols, coords
+
+
+def element_numbers(symbols):
+    """Atomic numbers for element symbols (dummy atoms are 0)."""
+    return atomic_numbers(symbols, extra=DUMMY_ATOMS)
+
+
+def perceive_bonds(numbers, coords, tolerance=BOND_TOLERANCE):
+    """
+    Distance based bond perception: atoms are bonded if closer than the sum of their
+    covalent radii plus tolerance. Dummy atoms (number 0) are never bonded.
+    Returns an (n_bonds, 2) array of atom indices.
+    """
+    radii = covalent_radii(numbers)
+    i, j = np.triu_indices(len(numbers), k=1)
+    d = np.linalg.norm(coords[i] - coords[j], axis=1)
+    bonded = (d < radii[i] + radii[j] + tolerance) & (numbers[i] > 0) & (numbers[j] > 0) & (d > 0.1)
+    return np.column_stack([i[bonded], j[bonded]]).astype(np.int64)
+
+
+def file_hash(filename):
+    """SHA1 hash of file contents."""
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _anchor_index(symbols, coords, alignment_site, tolerance=ANCHOR_TOLERANCE):
+    """
+    Real atom at the alignment site, which is bonded to the chassis.
+    -1 if there is none within tolerance (interlocked wheels such as CB[n] are not bonded to the chassis).
+    """
+    if alignment_site < 0:
+        return -1
+    d = np.linalg.norm(coords - coords[alignment_site], axis=1)
+    d[np.isin(symbols, list(DUMMY_ATOMS))] = np.inf
+    return int(np.argmin(d)) if d.min() <= tolerance else -1
+
+
+def _site_index(symbols, site):
+    idx = np.where(symbols == site)[0]
+    return int(idx[0]) if len(idx) > 0 else -1
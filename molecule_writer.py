@@ -0,0 +1,43 @@
+"""
+Molecule serialization for Nanocar plug-ins.
+Writes xyz and cjson directly from atom and coordinate arrays.
+"""
+import io
+import numpy as np
+
+
+XYZ_LINE = '%s %f %f %f\n'
+CHUNK_SIZE = 50000
+
+
+def xyz_string(atoms, coordinates, comment=''):
+    """Convert atom names and coordinates to xyz string."""
+    atoms, coordinates = np.asarray(atoms), np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    buffer = io.StringIO()
+    buffer.write('%i\n%s\n' % (len(atoms), comment))
+    for start in range(0, len(atoms), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, len(atoms))
+        rows = np.empty((end - start, 4), dtype=object)
+        rows[:, 0] = atoms[start:end]
+        rows[:, 1:] = coordinates[start:end]
+        buffer.write((XYZ_LINE * (end - start)) % tuple(rows.ravel().tolist()))
+    return buffer.getvalue()
+
+
+def cjson_dict(numbers, coordinates, bonds=None, bond_orders=None, name=None):
+    """
+    Convert atomic numbers, coordinates and bonds to Chemical JSON.
+    Bonds are given as an (n_bonds, 2) array of atom indices.
+    """
+    cjson = {'chemicalJson': 1,
+             'atoms': {'elements': {'number': np.asarray(numbers, dtype=int).tolist()},
+                       'coords': {'3d': np.asarray(coordinates, dtype=float).reshape(-1).tolist()}}}
+    if name is not None:
+        cjson['name'] = name
+    if bonds is not None and len(bonds) > 0:
+        bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+        if bond_orders is None:
+            bond_orders = np.ones(len(bonds), dtype=int)
+        cjson['bonds'] = {'connections': {'index': bonds.reshape(-1).tolist()},
+                          'order': np.asarray(bond_orders, dtype=int).tolist()}
+    return cjson
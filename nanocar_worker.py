@@ -0,0 +1,180 @@
+"""
+Nanocar Avogadro 2 plug-in - resident worker.
+Keeps plug-in modules and molecule/force field data loaded and serves plug-in
+commands over a local Unix socket, so each Avogadro action does not pay for
+interpreter startup and imports.
+
+Usage:
+ >>> python nanocar_worker.py          # start worker (foreground)
+ >>> python nanocar_worker.py --stop   # stop running worker
+
+Plug-in scripts forward their requests with `request` and fall back to
+running in-process if no worker is running (or NANOCAR_WORKER=0 is set).
+This module must stay cheap to import: only the standard library is used
+on the client side, and modules only needed to talk to a running worker
+are imported on demand.
+"""
+import os
+import sys
+import json
+import argparse
+
+
+PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
+SOCKET_FILE = os.environ.get('NANOCAR_WORKER_SOCKET', os.path.join(PLUGIN_DIR, '.nanocar-worker.sock'))
+COMMANDS = ['add_chassis', 'connect_wheel', 'surface_builder', 'lammps_setup']
+ACTIONS = ['print_options', 'run_command', 'run_workflow']
+
+
+def request(command, action, stdinStr=None, debug=()):
+    """
+    Forward a plug-in request to the worker.
+    Returns the text the plug-in script would print, or None if the worker is not available.
+    debug are the instrumentation modes for the request (see instrumentation.py).
+    """
+    if os.environ.get('NANOCAR_WORKER', '1') == '0' or not os.path.exists(SOCKET_FILE):
+        return None
+    import socket
+    message = {'command': command, 'action': action, 'stdin': stdinStr, 'cwd': os.getcwd(), 'debug': sorted(debug)}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(SOCKET_FILE)
+            sock.sendall(json.dumps(message).encode())
+            sock.shutdown(socket.SHUT_WR)
+            reply = json.loads(_recv_all(sock))
+    except (OSError, ValueError):
+        return None
+    if reply['status'] != 'ok':
+        # Let the in-process fallback raise the error as usual
+        return None
+    return reply['stdout']
+
+
+def serve(socket_file=SOCKET_FILE):
+    """Load all plug-in modules and serve requests until stopped."""
+    import socket
+    import importlib
+    if PLUGIN_DIR not in sys.path:
+        sys.path.insert(0, PLUGIN_DIR)
+    modules = {command: importlib.import_module(command) for command in COMMANDS}
+    warm_up()
+
+    if os.path.exists(socket_file):
+        if _is_alive(socket_file):
+            print('Worker already running -> %s' % socket_file)
+            return
+        os.remove(socket_file)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_file)
+        os.chmod(socket_file, 0o600)
+        server.listen()
+        print('Nanocar worker listening -> %s' % socket_file)
+        try:
+            while True:
+                conn, _ = server.accept()
+                with conn:
+                    try:
+                        data = _recv_all(conn)
+                        if not data:
+                            continue
+                        message = json.loads(data)
+                        if not isinstance(message, dict):
+                            raise ValueError('Request must be a JSON object')
+                        if message.get('action') == 'stop':
+                            conn.sendall(json.dumps({'status': 'ok', 'stdout': ''}).encode())
+                            break
+                        reply = handle(modules, message)
+                    except (ValueError, KeyError, TypeError) as error:
+                        # Malformed request: the client runs the command in-process, the worker keeps serving
+                        reply = {'status': 'error', 'error': 'Invalid request: %s' % error}
+                    except OSError:
+                        # Client went away
+                        continue
+                    try:
+                        conn.sendall(json.dumps(reply).encode())
+                    except OSError:
+                        continue
+        finally:
+            os.remove(socket_file)
+
+
+def handle(modules, message):
+    """Run a single plug-in request and capture what it would print."""
+    import io
+    import traceback
+    import contextlib
+    from instrumentation import run, dumps, debug_modes
+    command, action = message.get('command'), message.get('action')
+    if command not in modules or action not in ACTIONS:
+        return {'status': 'error', 'error': 'Unknown request: %s %s' % (command, action)}
+    stdout = io.StringIO()
+    cwd = os.getcwd()
+    try:
+        os.chdir(message['cwd'])
+        with contextlib.redirect_stdout(stdout):
+            if action == 'print_options':
+                print(json.dumps(modules[command].get_options()))
+            else:
+                # Instrumented if requested by the plug-in script or enabled for the worker itself
+                modes = set(message.get('debug', [])) | debug_modes()
+                func = getattr(modules[command], action)
+                print(run(command, action, lambda: dumps(func(message['stdin'])), modes=modes))
+    except Exception:
+        return {'status': 'error', 'error': traceback.format_exc()}
+    finally:
+        os.chdir(cwd)
+    return {'status': 'ok', 'stdout': stdout.getvalue().rstrip('\n')}
+
+
+def warm_up():
+    """Preload wheel and chassis libraries."""
+    from molecule_library import load_library
+    load_library(os.path.join(PLUGIN_DIR, 'wheel'))
+    load_library(os.path.join(PLUGIN_DIR, 'chassis'))
+
+
+def stop(socket_file=SOCKET_FILE):
+    """Ask running worker to stop."""
+    import socket
+    if not _is_alive(socket_file):
+        print('No worker running.')
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_file)
+        sock.sendall(json.dumps({'action': 'stop'}).encode())
+        sock.shutdown(socket.SHUT_WR)
+        _recv_all(sock)
+    print('Worker stopped.')
+
+
+def _is_alive(socket_file):
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_file)
+        return True
+    except OSError:
+        return False
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(1 << 20)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks).decode()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Nanocar plug-in worker')
+    parser.add_argument('--stop', action='store_true', help='Stop running worker.')
+    parser.add_argument('--socket', type=str, default=SOCKET_FILE, help='Unix socket path.')
+    args = vars(parser.parse_args())
+
+    if args['stop']:
+        stop(args['socket'])
+    else:
+        serve(args['socket'])
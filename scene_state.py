@@ -0,0 +1,120 @@
+"""
+Scene state for Nanocar documents.
+Each plug-in action that adds atoms (chassis, wheels, metal surface) records the added components
+with their atom id ranges. Scenes are stored as small JSON files keyed by the atomic numbers of
+the whole document, so the state of a document is found again from the atoms passed to the next
+plug-in (unaffected by moving atoms). Documents with the same atomic numbers in the same order share
+a scene file, the last one written is used for all of them; documents that differ in any atom never do.
+Files are immutable once written (written to a temporary file and renamed), so no locking is needed.
+There is no scene for a document whose atoms were changed after the last plug-in action, whose scene
+was pruned (unused for SCENE_MAX_AGE) or that was built by an older version of the plug-ins.
+
+Components are dicts with kind ('chassis', 'wheel' or 'surface'), name and id ([first, last], 1-based
+as in LAMMPS). Surfaces also store their cell size (x, y) and wheels the chassis atom id they are bonded to
+(site) and the id of the wheel atom bonded to it (anchor).
+"""
+import os
+import json
+import time
+import hashlib
+
+
+PLUGIN_DIR = os.path.abspath(os.path.dirname(__file__))
+SCENE_DIR = os.path.join(PLUGIN_DIR, '.scenes')
+SCENE_VERSION = 1
+# Scene files not used for this long (s) are removed when new scenes are written
+SCENE_MAX_AGE = 30 * 24 * 3600
+
+
+def scene_key(numbers):
+    """Key of a document from its atomic numbers (in atom order)."""
+    import numpy as np
+    return hashlib.sha1(','.join(map(str, np.asarray(numbers, dtype=np.int64).tolist())).encode()).hexdigest()
+
+
+def read_scene(numbers, scene_dir=SCENE_DIR):
+    """Components recorded for a document with these atomic numbers (None if there is no scene for it)."""
+    scene_file = os.path.join(scene_dir, '%s.json' % scene_key(numbers))
+    scene = read_scene_file(scene_file)
+    if scene is None or scene['n_atoms'] != len(numbers):
+        return None
+    try:
+        # Mark the scene as recently used
+        os.utime(scene_file, None)
+    except OSError:
+        pass
+    return scene['components']
+
+
+def record_components(numbers, new_numbers, components, scene_dir=SCENE_DIR):
+    """
+    Record components appended to a document.
+    numbers are the atomic numbers of the document before, new_numbers the appended atoms and the
+    ids of the components (and wheel anchors) count from the first appended atom. Returns all components of the new document.
+    """
+    import numpy as np
+    numbers, new_numbers = np.asarray(numbers, dtype=np.int64), np.asarray(new_numbers, dtype=np.int64)
+    offset = len(numbers)
+    scene = (read_scene(numbers, scene_dir) or []) if offset else []
+    scene = scene + [dict(c, id=[c['id'][0] + offset, c['id'][1] + offset],
+                          **({'anchor': c['anchor'] + offset} if 'anchor' in c else {})) for c in components]
+    os.makedirs(scene_dir, exist_ok=True)
+    write_scene_file(os.path.join(scene_dir, '%s.json' % scene_key(np.concatenate([numbers, new_numbers]))),
+                     len(numbers) + len(new_numbers), scene)
+    prune_scenes(scene_dir)
+    return scene
+
+
+def document_numbers(opts):
+    """Atomic numbers of the document passed to a plug-in (empty if there is none)."""
+    return opts.get('cjson', {}).get('atoms', {}).get('elements', {}).get('number', [])
+
+
+def read_scene_file(scene_file):
+    """Read scene file, None if it does not exist or is from another version."""
+    try:
+        with open(scene_file, 'r') as f:
+            scene = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return scene if scene.get('version') == SCENE_VERSION else None
+
+
+def write_scene_file(scene_file, n_atoms, components):
+    """Write scene file atomically (temporary file renamed over the target)."""
+    tmp_file = '%s.%i.tmp' % (scene_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': SCENE_VERSION, 'n_atoms': n_atoms, 'components': components}, f)
+    os.replace(tmp_file, scene_file)
+
+
+def prune_scenes(scene_dir=SCENE_DIR, max_age=SCENE_MAX_AGE):
+    """Remove scene files that were not used for max_age seconds."""
+    now = time.time()
+    for name in os.listdir(scene_dir):
+        path = os.path.join(scene_dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            # Removed by another process
+            continue
+
+
+def component_mask(components, n_atoms, kinds):
+    """Boolean mask of atoms belonging to components of the given kind(s)."""
+    import numpy as np
+    kinds = [kinds] if isinstance(kinds, str) else kinds
+    mask = np.zeros(n_atoms, dtype=bool)
+    for c in components:
+        if c['kind'] in kinds:
+            mask[c['id'][0] - 1:c['id'][1]] = True
+    return mask
+
+
+def id_ranges(mask):
+    """Ranges ([first, last], 1-based) of consecutive atoms in a boolean mask."""
+    import numpy as np
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8), [0]]))
+    starts, ends = np.where(edges == 1)[0] + 1, np.where(edges == -1)[0]
+    return [[int(s), int(e)] for s, e in zip(starts, ends)]
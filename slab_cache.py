@@ -0,0 +1,79 @@
+"""
+On-disk LRU cache for metal slabs built by the surface builder.
+Each slab is stored as a .npz file (atomic numbers, positions, cell, pbc) named by
+the hash of the options used to build it. Least recently used slabs are evicted
+when the cache exceeds MAX_ENTRIES files or MAX_BYTES in total.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+
+CACHE_DIR = os.environ.get('NANOCAR_SLAB_CACHE',
+                           os.path.join(os.path.abspath(os.path.dirname(__file__)), '.slab_cache'))
+MAX_ENTRIES = 64
+MAX_BYTES = 512 * 1024 ** 2
+
+
+def slab_key(surface, metal, a, size, vacuum, orthogonal):
+    """Cache key for a slab from the full set of builder options."""
+    options = [surface, metal, a, [int(i) for i in size], vacuum, bool(orthogonal)]
+    return hashlib.sha1(json.dumps(options).encode()).hexdigest()
+
+
+def load_slab(key, cache_dir=CACHE_DIR):
+    """Load slab arrays from cache, returns None if not cached."""
+    cache_file = os.path.join(cache_dir, '%s.npz' % key)
+    try:
+        with np.load(cache_file) as npz:
+            slab = dict(npz)
+        # Mark as recently used
+        os.utime(cache_file)
+    except (OSError, ValueError):
+        return None
+    return slab
+
+
+def save_slab(key, slab, cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+    """Save slab arrays to cache and evict least recently used slabs if needed."""
+    cache_file = os.path.join(cache_dir, '%s.npz' % key)
+    tmp_file = '%s.%i.tmp.npz' % (cache_file[:-4], os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(tmp_file, **slab)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return
+    evict(cache_dir, max_entries, max_bytes)
+
+
+def evict(cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, suffix='.npz'):
+    """
+    Remove least recently used files (ending with suffix) until the cache is within limits.
+    Also used for other file caches of the plug-ins (see lammps_writer.write_atoms).
+    """
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith(suffix) and '.tmp' not in f:
+            stat = os.stat(os.path.join(cache_dir, f))
+            entries.append((stat.st_mtime, stat.st_size, f))
+    entries.sort(reverse=True)
+    total = 0
+    for idx, (_, size, f) in enumerate(entries):
+        total += size
+        if idx >= max_entries or total > max_bytes:
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except OSError:
+                pass
+
+
+def clear(cache_dir=CACHE_DIR):
+    """Remove all cached slabs."""
+    if os.path.isdir(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.npz'):
+                os.remove(os.path.join(cache_dir, f))
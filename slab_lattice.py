@@ -0,0 +1,197 @@
+"""
+Native numpy metal slab generator.
+Builds the surfaces offered by the surface builder by broadcasting a small basis over an
+integer lattice grid. Atom order, positions and cells match `ase.build` exactly, including
+the centering done by the surface builder (`center(about=(0, 0, -vacuum))`).
+Slabs can be generated in chunks of layers so that very large slabs can be streamed.
+"""
+import numpy as np
+from elements import atomic_numbers
+
+
+# Cell vectors for each surface in units of the lattice constant (ase.build conventions)
+SLAB_CELLS = {'fcc100': (np.sqrt(0.5), np.sqrt(0.5), 0.5),
+              'fcc110': (1.0, np.sqrt(0.5), np.sqrt(0.125)),
+              'bcc100': (1.0, 1.0, 0.5),
+              'fcc111': (np.sqrt(0.5), np.sqrt(0.375), 1 / np.sqrt(3)),
+              'bcc110': (1.0, np.sqrt(0.5), np.sqrt(0.5)),
+              'bcc111': (np.sqrt(2), np.sqrt(1.5), np.sqrt(3) / 6)}
+SQUARE_SURFACES = ['fcc100', 'fcc110', 'bcc100']
+SURFACES = list(SLAB_CELLS) + ['fcc211']
+
+
+def build_slab(surface, metal, a, size, vacuum, orthogonal=True, chunk_layers=None):
+    """Build slab as arrays (numbers, positions, cell, pbc)."""
+    slab = SlabLattice(surface, metal, a, size, vacuum, orthogonal)
+    positions = np.concatenate(list(slab.iter_positions(chunk_layers)))
+    return {'numbers': np.full(len(positions), slab.number), 'positions': positions,
+            'cell': slab.cell, 'pbc': slab.pbc}
+
+
+class SlabLattice:
+    """
+    Metal slab defined on an integer lattice grid.
+    Positions are generated layer by layer in the same order as ase.build
+    (bottom layer first, except for fcc211 which is ordered from the top down).
+    """
+    def __init__(self, surface, metal, a, size, vacuum, orthogonal=True):
+        if surface not in SURFACES:
+            raise ValueError('Unknown surface: %s' % surface)
+        self.surface, self.size, self.orthogonal = surface, [int(i) for i in size], bool(orthogonal)
+        self.number = int(atomic_numbers([metal])[0])
+        self.a = reference_lattice_constant(metal, surface[:3]) if a is None else a
+        self.pbc = np.array([True, True, False])
+        self.n_atoms = int(np.prod(self.size))
+        if surface == 'fcc211':
+            if not self.orthogonal:
+                raise NotImplementedError('Only implemented for orthogonal unit cells.')
+            if self.size[0] % 3 != 0:
+                raise NotImplementedError('First dimension of size must be divisible by 3.')
+            cell = np.diag([np.sqrt(3) * self.size[0] / 3, self.size[1] / np.sqrt(2), 0.0]) * self.a
+            self.n_layers = 3 * self.size[2]
+            self.layer_size = self.size[0] // 3 * self.size[1]
+            # ase.build only centers fcc211 slabs for non-zero vacuum
+            slab_vacuum = vacuum if vacuum else None
+        else:
+            if surface in SQUARE_SURFACES and not self.orthogonal:
+                raise NotImplementedError("Can't do non-orthogonal cell yet!")
+            if surface not in SQUARE_SURFACES and self.orthogonal and self.size[1] % 2 == 1:
+                raise ValueError("Can't make orthorhombic cell with size=%r.  Second number in size must be even."
+                                 % (tuple(self.size),))
+            c = SLAB_CELLS[surface]
+            if self.orthogonal:
+                self.basis = np.diag(c)
+            else:
+                self.basis = np.array([(c[0], 0, 0), (c[0] / 2, c[1], 0), (0, 0, c[2])])
+            cell = self.a * self.basis * np.array(self.size)[:, None]
+            cell[2] = 0.0
+            self.n_layers = self.size[2]
+            self.layer_size = self.size[0] * self.size[1]
+            slab_vacuum = vacuum
+
+        # Centering only depends on the extent of the slab along the cell face normals
+        dirs = _face_normals(cell)
+        p0, p1 = np.full(3, np.inf), np.full(3, -np.inf)
+        for positions in self._iter_raw_positions():
+            proj = positions @ dirs.T
+            p0, p1 = np.minimum(p0, proj.min(axis=0)), np.maximum(p1, proj.max(axis=0))
+
+        translation = np.zeros(3)
+        if slab_vacuum is not None:
+            cell, shift = _center(cell, p0, p1, vacuum=slab_vacuum, axes=[2])
+            translation += shift
+        cell, shift = _center(cell, p0 + translation @ dirs.T, p1 + translation @ dirs.T,
+                              about=(0, 0, -vacuum))
+        self.cell, self.translation = cell, translation + shift
+
+    def iter_positions(self, chunk_layers=None):
+        """Yield atom positions in chunks of layers (all layers at once by default)."""
+        for positions in self._iter_raw_positions(chunk_layers):
+            yield positions + self.translation
+
+    def _iter_raw_positions(self, chunk_layers=None):
+        chunk_layers = self.n_layers if chunk_layers is None else max(int(chunk_layers), 1)
+        for start in range(0, self.n_layers, chunk_layers):
+            layers = np.arange(start, min(start + chunk_layers, self.n_layers))
+            if self.surface == 'fcc211':
+                yield self._fcc211_positions(layers)
+            else:
+                yield self.a * (self._fractional_positions(layers) @ self.basis)
+
+    def _fractional_positions(self, layers):
+        """Lattice grid positions for given layers with the surface specific layer/row offsets."""
+        nx, ny, nz = self.size
+        pos = np.empty((len(layers), ny, nx, 3))
+        pos[..., 0] = np.arange(nx)[None, None, :]
+        pos[..., 1] = np.arange(ny)[None, :, None]
+        pos[..., 2] = layers[:, None, None]
+        # Offsets are defined by the layer counted from the top (r) and the row (odd rows)
+        r = (nz - 1 - layers)[:, None, None]
+        odd_row = (np.arange(ny) % 2 == 1)[None, :, None]
+        if self.surface in SQUARE_SURFACES:
+            pos[..., :2] += 0.5 * (r % 2 == 1)[..., None]
+        elif self.surface in ['fcc111', 'bcc111']:
+            if self.orthogonal:
+                pos[..., 0] += 0.5 * ((r % 3 != 2) & odd_row) - 0.5 * ((r % 3 == 2) & odd_row)
+                pos[..., :2] += np.where((r % 3 == 1)[..., None], (0.0, 2.0 / 3), 0.0)
+                pos[..., :2] += np.where((r % 3 == 2)[..., None], (0.5, 1.0 / 3), 0.0)
+            else:
+                pos[..., :2] += np.where((r % 3 == 1)[..., None], (-1.0 / 3, 2.0 / 3), 0.0)
+                pos[..., :2] += np.where((r % 3 == 2)[..., None], (1.0 / 3, 1.0 / 3), 0.0)
+        elif self.surface == 'bcc110':
+            if self.orthogonal:
+                pos[..., 0] += 0.5 * odd_row
+                pos[..., :2] += np.where((r % 2 == 1)[..., None], (0.0, 1.0), 0.0)
+            else:
+                pos[..., :2] += np.where((r % 2 == 1)[..., None], (-0.5, 1.0), 0.0)
+        return pos.reshape(-1, 3)
+
+    def _fcc211_positions(self, layers):
+        """
+        FCC(211) step atoms: each (1 -1 -1) x (0 1 -1) cell holds one atom per layer, every third
+        layer completes a step. Atoms are ordered from the top layer down, then by x and y.
+        """
+        nx, ny = self.size[0] // 3, self.size[1]
+        # Odd number of layers drops the bottom three atomic layers of the repeated unit
+        m = self.n_layers - 1 - layers + (3 if self.size[2] % 2 else 0)
+        height = self.n_layers - 1 - layers
+        pos = np.empty((len(layers), nx, ny, 3))
+        pos[..., 0] = ((m % 3) / np.sqrt(3))[:, None, None] + np.sqrt(3) * np.arange(nx)[None, :, None]
+        pos[..., 1] = ((m % 2) / np.sqrt(8))[:, None, None] + np.arange(ny)[None, None, :] / np.sqrt(2)
+        pos[..., 2] = (height * np.sqrt(6) / 12)[:, None, None]
+        return self.a * pos.reshape(-1, 3)
+
+
+def reference_lattice_constant(metal, structure):
+    """Reference lattice constant from ASE for metals without a given lattice constant."""
+    from ase.data import reference_states, atomic_numbers
+    state = reference_states[atomic_numbers[metal]]
+    if state['symmetry'] != structure:
+        raise ValueError("Can't guess lattice constant for %s-%s!" % (structure, metal))
+    return state['a']
+
+
+def _complete(cell):
+    """Replace missing (zero) cell vectors with orthogonal unit vectors."""
+    cell = np.array(cell, dtype=float)
+    for i in range(3):
+        if not cell[i].any():
+            v = np.cross(cell[i - 2], cell[i - 1])
+            cell[i] = v / np.linalg.norm(v)
+    return cell
+
+
+def _face_normals(cell):
+    """Unit normals of the cell faces, pointing along the corresponding cell vectors."""
+    cell = _complete(cell)
+    dirs = np.array([np.cross(cell[i - 1], cell[i - 2]) for i in range(3)])
+    dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+    dirs[np.einsum('ij,ij->i', dirs, cell) < 0] *= -1
+    return dirs
+
+
+def _center(cell, p0, p1, vacuum=None, axes=(0, 1, 2), about=None):
+    """
+    Port of ase.Atoms.center working on slab extents (p0, p1) along the face normals.
+    Returns the new cell and the translation to apply to all atoms.
+    """
+    cell = np.array(cell, dtype=float)
+    completed = _complete(cell)
+    dirs = _face_normals(cell)
+    lengths = np.linalg.norm(completed, axis=1)
+    translation = np.zeros(3)
+    for i in axes:
+        height = completed[i] @ dirs[i]
+        lng = (p1[i] - p0[i] + 2 * vacuum) - height if vacuum is not None else 0.0
+        shf = 0.5 * (lng + height - p1[i] - p0[i])
+        cosphi = height / lengths[i]
+        if vacuum is not None:
+            cell[i] = completed[i] * (1 + lng / cosphi / lengths[i])
+        translation += shf / cosphi * completed[i] / lengths[i]
+        if not cell[i].any():
+            translation[i] -= 0.5
+    if about is not None:
+        for n in axes:
+            translation -= cell[n] / 2.0
+            translation[n] += about[n]
+    return cell, translation
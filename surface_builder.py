@@ -8,7 +8,8 @@ import os
 import sys
 import json
 import argparse
-import ase.build
+from nanocar_worker import request
+from instrumentation import stage, run, dumps, debug_modes
 
 
 # Some globals:
@@ -61,46 +62,74 @@ def get_options():
 
 def build_surface(opts):
     """Builds crystal surface."""
-    builder = getattr(ase.build, opts['surface'])
     size = [opts['size-x'], opts['size-y'], opts['size-z']]
-    ase_surf = builder(opts['metal'], a=opts['a'], size=size, vacuum=opts['vacuum'], orthogonal=opts['orthogonal'])
-    ase_surf.center(about=(0, 0, -opts['vacuum']))
-    # Get surface atom id to keep track of surface atoms
-    try:
-        surf_atom_id = int(len(opts['cjson']['atoms']['coords']['3d']) / 3 + 1)
-    except KeyError:
-        surf_atom_id = 1
-    surface_info = {'x': ase_surf.cell[0][0], 'y': ase_surf.cell[1][1],
-                    'id': [surf_atom_id, ase_surf.get_number_of_atoms() + surf_atom_id - 1]}
-    write_surface_info(surface_info)
-    return ase2xyz(ase_surf)
-
-
-def write_surface_info(surface_info):
-    """Write surface size to a file to be read later to get the correct simulation box size."""
-    with open(os.path.join(PLUGIN_DIR, 'surface_info.json'), 'w') as outfile:
-        json.dump(surface_info, outfile)
-
-
-def ase2xyz(atoms):
-    """Converts ASE Atoms object to xyz string"""
-    atoms.write('temp.xyz', append=False)
-    xyz = ""
-    with open('temp.xyz', 'r') as f:
-        for line in f:
-            xyz += line
-    return xyz
-
-
-def run_workflow():
+    orthogonal = opts['orthogonal'] in [True, 'True']
+    with stage('build_slab') as entry:
+        slab = build_slab(opts['surface'], opts['metal'], opts['a'], size, opts['vacuum'], orthogonal)
+        entry['atoms'] = len(slab['numbers'])
+    with stage('cjson', atoms=len(slab['numbers'])):
+        return slab2cjson(slab)
+
+
+def build_slab(surface, metal, a, size, vacuum, orthogonal=True, cache=True):
+    """
+    Build metal slab as arrays (numbers, positions, cell, pbc).
+    Slabs are generated with the numpy lattice engine (identical to ase.build) and
+    cached on disk by their options so rebuilding the same slab is a single file read.
+    """
+    from slab_cache import slab_key, load_slab, save_slab
+    import slab_lattice
+    key = slab_key(surface, metal, a, size, vacuum, orthogonal)
+    slab = load_slab(key) if cache else None
+    if slab is None:
+        slab = slab_lattice.build_slab(surface, metal, a, size, vacuum, orthogonal)
+        if cache:
+            save_slab(key, slab)
+    return slab
+
+
+def surface_component(cjson, name, first=1):
+    """Scene component for a surface: atom ids and cell size in x and y (used for the simulation box)."""
+    cell = cjson['unitCell']['cellVectors']
+    return {'kind': 'surface', 'name': name, 'id': [first, first + len(cjson['atoms']['elements']['number']) - 1],
+            'x': float(cell[0]), 'y': float(cell[4])}
+
+
+def slab2cjson(slab):
+    """Converts slab arrays to Chemical JSON (metal surfaces have no bonds)"""
+    import numpy as np
+    from molecule_writer import cjson_dict
+    from elements import symbols
+    elements, counts = np.unique(slab['numbers'], return_counts=True)
+    cjson = cjson_dict(slab['numbers'], slab['positions'],
+                       name=''.join('%s%i' % (s, n) for s, n in zip(symbols(elements), counts)))
+    cell = np.asarray(slab['cell'])
+    a, b, c = np.linalg.norm(cell, axis=1)
+    alpha, beta, gamma = [np.degrees(np.arccos(np.dot(cell[i], cell[j]) / (lengths[0] * lengths[1])))
+                          for i, j, lengths in [(1, 2, (b, c)), (0, 2, (a, c)), (0, 1, (a, b))]]
+    cjson['unitCell'] = {'a': float(a), 'b': float(b), 'c': float(c),
+                         'alpha': float(alpha), 'beta': float(beta), 'gamma': float(gamma),
+                         'cellVectors': cell.ravel().tolist()}
+    return cjson
+
+
+def run_workflow(stdinStr=None):
     """Run surface builder."""
-    stdinStr = sys.stdin.read()
-    opts = json.loads(stdinStr)
+    if stdinStr is None:
+        stdinStr = sys.stdin.read()
+    from cjson_io import loads
+    with stage('parse_input', nbytes=len(stdinStr)):
+        opts = loads(stdinStr)
 
     result = {}
     result['append'] = True
-    result['moleculeFormat'] = 'xyz'
-    result['xyz'] = build_surface(opts)
+    result['moleculeFormat'] = 'cjson'
+    result['cjson'] = build_surface(opts)
+    # Keep track of the surface atoms in the document
+    from scene_state import record_components, document_numbers
+    with stage('record_scene'):
+        record_components(document_numbers(opts), result['cjson']['atoms']['elements']['number'],
+                          [surface_component(result['cjson'], '%s-%s' % (opts['surface'], opts['metal']))])
     return result
 
 
@@ -114,13 +143,18 @@ if __name__ == "__main__":
     parser.add_argument('--lang', nargs='?', default='en')
     args = vars(parser.parse_args())
 
-    debug = args['debug']
+    debug = debug_modes(args['debug'])
 
     if args['display_name']:
         print("Metal Surface")
     if args['menu_path']:
         print("&Build|Nanocar")
     if args['print_options']:
-        print(json.dumps(get_options()))
+        reply = request('surface_builder', 'print_options')
+        print(reply if reply is not None else json.dumps(get_options()))
     elif args['run_workflow']:
-        print(json.dumps(run_workflow()))
+        stdinStr = sys.stdin.read()
+        reply = request('surface_builder', 'run_workflow', stdinStr, debug=debug)
+        if reply is None:
+            reply = run('surface_builder', 'run_workflow', lambda: dumps(run_workflow(stdinStr)), modes=debug)
+        print(reply)
@@ -0,0 +1,106 @@
+"""
+Placement of nanocars over metal surfaces.
+Each nanocar is moved over its site on the surface with its lowest atom at a target gap
+above the top surface layer. Heights and in-plane offsets around that position are then
+scanned with a single point Lennard-Jones energy (force field parameters, arithmetic mixing
+as in the LAMMPS input) and the lowest energy position without overlapping atoms is kept.
+Nanocars are checked against each other with minimum image distances in the surface plane (periodic in x and y),
+a nanocar that cannot be placed without overlap raises an error.
+Surface atoms within reach of a nanocar are found once with a cell list, all scan
+positions are evaluated at once from those atom pairs.
+"""
+import numpy as np
+from cell_list import CellList
+from forcefield import pair_coefficients
+
+
+LJ_CUTOFF = 12.5
+MIN_DISTANCE = 2.0
+HEIGHTS = np.linspace(-1.5, 1.5, 13)
+OFFSETS = np.linspace(-1.0, 1.0, 5)
+PAIR_CHUNK = 2000000
+
+
+def place_nanocars(cars, slab_numbers, slab_positions, cell, gap=3.0, sites=None,
+                   heights=HEIGHTS, offsets=OFFSETS, min_distance=MIN_DISTANCE, cutoff=LJ_CUTOFF, forcefield='UFF'):
+    """
+    Place nanocars over a metal slab.
+    cars is a list of (atomic numbers, coordinates) pairs. Unless sites (in-plane positions) are given
+    the nanocars are spread on a grid over the surface cell. Heights (relative to the gap) and in-plane
+    offsets (Å) are scanned for each nanocar, nanocars placed earlier (and their periodic images in x and y)
+    count as obstacles for overlap. Raises ValueError if a nanocar has no position at least min_distance
+    away from the surface and the other nanocars.
+    Returns the placed coordinates and the LJ energy (kcal/mol) with the surface for each nanocar.
+    """
+    slab_positions = np.asarray(slab_positions, dtype=float).reshape(-1, 3)
+    if sites is None:
+        sites = grid_sites(len(cars), cell, slab_positions[:, :2].mean(axis=0))
+    top = slab_positions[:, 2].max()
+    scan = np.array([(dx, dy, dz) for dz in heights for dx in offsets for dy in offsets])
+    reach = cutoff + np.abs(scan).max(axis=0).max()
+
+    # Only the upper layers of the slab are within reach of the nanocars
+    upper = slab_positions[:, 2] > top - reach
+    slab_numbers, slab_positions = np.asarray(slab_numbers)[upper], slab_positions[upper]
+    surface = CellList(slab_positions, reach)
+    # In-plane periodic images (the 3 x 3 neighbouring cells) for the nanocar - nanocar check
+    cell = np.asarray(cell, dtype=float)
+    images = np.array([i * cell[0] + j * cell[1] for i in (-1, 0, 1) for j in (-1, 0, 1)])
+    images[:, 2] = 0.0
+
+    placed, energies = [], []
+    for (numbers, coords), site in zip(cars, sites):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 3).copy()
+        coords[:, :2] += np.asarray(site[:2]) - coords[:, :2].mean(axis=0)
+        coords[:, 2] += top + gap - coords[:, 2].min()
+        energy, clearance = scan_energies(numbers, coords, slab_numbers, slab_positions, surface, scan,
+                                          cutoff, forcefield)
+        if placed:
+            # Keep clear of the other nanocars
+            shifted = (coords[None, :, :] + scan[:, None, :]).reshape(-1, 3)
+            others = (np.vstack(placed)[None, :, :] + images[:, None, :]).reshape(-1, 3)
+            d = CellList(others, min_distance).min_distances(shifted)
+            clearance = np.minimum(clearance, d.reshape(len(scan), -1).min(axis=1))
+        allowed = clearance >= min_distance
+        if not allowed.any():
+            raise ValueError('Could not place nanocar %i of %i at least %.2f Å from the surface and the other '
+                             'nanocars (closest: %.2f Å), use a larger surface or fewer nanocars!'
+                             % (len(placed) + 1, len(cars), min_distance, clearance.max()))
+        best = int(np.argmin(np.where(allowed, energy, np.inf)))
+        placed.append(coords + scan[best])
+        energies.append(float(energy[best]))
+    return placed, energies
+
+
+def scan_energies(numbers, coords, slab_numbers, slab_positions, surface, scan, cutoff=LJ_CUTOFF, forcefield='UFF'):
+    """
+    LJ energy between a nanocar and surface atoms and their minimum distance for each scan shift.
+    Atom pairs are collected once with the cell list (whose cutoff covers the largest shift).
+    """
+    q, p, _ = surface.pairs(coords)
+    elements = np.unique(np.concatenate([numbers, slab_numbers]))
+    car_types, slab_types = np.searchsorted(elements, numbers), np.searchsorted(elements, slab_numbers)
+    pair_eps, pair_sig = pair_coefficients(elements, forcefield)
+    pair_eps, pair_sig = pair_eps[car_types[q], slab_types[p]], pair_sig[car_types[q], slab_types[p]]
+    diff = coords[q] - slab_positions[p]
+
+    energy, clearance = np.zeros(len(scan)), np.full(len(scan), np.inf)
+    # Evaluate several shifts at once while keeping the (shift, pair) array bounded
+    step = max(1, PAIR_CHUNK // max(len(q), 1))
+    for start in range(0, len(scan), step):
+        shifts = scan[start:start + step]
+        r2 = ((diff[None, :, :] + shifts[:, None, :]) ** 2).sum(axis=2)
+        sr6 = (pair_sig[None, :] ** 2 / r2) ** 3
+        e = np.where(r2 < cutoff ** 2, 4 * pair_eps * (sr6 ** 2 - sr6), 0.0)
+        energy[start:start + step] = e.sum(axis=1)
+        if r2.shape[1] > 0:
+            clearance[start:start + step] = np.sqrt(r2.min(axis=1))
+    return energy, clearance
+
+
+def grid_sites(n_cars, cell, center):
+    """In-plane positions spreading n_cars evenly over the surface cell around its center."""
+    nx = int(np.ceil(np.sqrt(n_cars)))
+    ny = int(np.ceil(n_cars / nx))
+    frac = np.array([((i % nx + 0.5) / nx - 0.5, (i // nx + 0.5) / ny - 0.5) for i in range(n_cars)])
+    return frac.reshape(-1, 2) @ np.asarray(cell, dtype=float)[:2, :2] + center
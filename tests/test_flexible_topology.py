@@ -0,0 +1,42 @@
+"""
+Bonds written for flexible nanocars: every bond in data.nanocar must be a real (short) bond,
+including the wheel - chassis bonds and none for interlocked wheels (CB[n]).
+Skipped if the plug-in dependencies are not installed.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('angstrom')
+pytest.importorskip('periodictable')
+from batch_builder import expand_jobs, build_system
+
+
+MAX_BOND = 2.0
+SPEC = {'chassis': ['chassis-H2-cd'], 'sites': {'chassis-H2-cd': [80, 81, 84, 85]},
+        'surfaces': [{'surface': 'fcc111', 'metal': 'Au', 'a': 4.08, 'size': [12, 12, 3]}],
+        'lammps': {'flexible': True}, 'min_clearance': 0.0}
+
+
+def read_data_bonds(data_file):
+    """Atom coordinates (by atom id) and bonds (atom id pairs) in a LAMMPS data file."""
+    with open(data_file, 'r') as f:
+        sections = f.read().split('\n\n')
+    titles = [s.strip() for s in sections]
+    atoms = np.array(sections[titles.index('Atoms') + 1].split(), dtype=float).reshape(-1, 7)
+    coords = np.zeros((int(atoms[:, 0].max()) + 1, 3))
+    coords[atoms[:, 0].astype(int)] = atoms[:, 4:7]
+    bonds = np.array(sections[titles.index('Bonds') + 1].split(), dtype=int).reshape(-1, 4)[:, 2:]
+    return coords, bonds
+
+
+@pytest.mark.parametrize('wheel', ['C60', 'CB[5]', 'CB[7]', 'CB[10]'])
+def test_bond_lengths(wheel, tmp_path):
+    job, = expand_jobs(dict(SPEC, wheels=[wheel], output=str(tmp_path)))
+    build_system(job)
+    coords, bonds = read_data_bonds(os.path.join(job['dir'], 'data.nanocar'))
+    lengths = np.linalg.norm(coords[bonds[:, 0]] - coords[bonds[:, 1]], axis=1)
+    assert len(bonds) > 0
+    assert lengths.max() < MAX_BOND, 'bond of %.2f Å between atoms %s' % (lengths.max(), bonds[lengths.argmax()])
@@ -0,0 +1,52 @@
+"""
+Compare the numpy slab engine (slab_lattice) with ase.build for every surface offered by the surface builder.
+Skipped if ASE is not installed.
+"""
+import os
+import sys
+import itertools
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ase_build = pytest.importorskip('ase.build')
+import slab_lattice
+from surface_builder import surface_selections
+
+
+SIZES = [(3, 2, 1), (3, 4, 3), (6, 2, 4)]
+VACUA = [0.0, 5.0, 12.5]
+
+
+def ase_slab(surface, metal, a, size, vacuum, orthogonal):
+    """Slab built as in the original surface builder."""
+    atoms = getattr(ase_build, surface)(metal, a=a, size=size, vacuum=vacuum, orthogonal=orthogonal)
+    atoms.center(about=(0, 0, -vacuum))
+    return atoms
+
+
+@pytest.mark.parametrize('surface', surface_selections)
+@pytest.mark.parametrize('orthogonal', [True, False])
+@pytest.mark.parametrize('size,vacuum', list(itertools.product(SIZES, VACUA)))
+def test_slab_matches_ase(surface, orthogonal, size, vacuum):
+    metal, a = ('Fe', 2.87) if surface.startswith('bcc') else ('Au', 4.08)
+    try:
+        reference = ase_slab(surface, metal, a, size, vacuum, orthogonal)
+    except (ValueError, NotImplementedError) as error:
+        # Combinations ase.build does not support are rejected the same way
+        with pytest.raises(type(error)):
+            slab_lattice.build_slab(surface, metal, a, size, vacuum, orthogonal)
+        return
+    slab = slab_lattice.build_slab(surface, metal, a, size, vacuum, orthogonal)
+    np.testing.assert_array_equal(slab['numbers'], reference.numbers)
+    np.testing.assert_allclose(slab['positions'], reference.positions, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(slab['cell'], reference.cell[:], rtol=0, atol=1e-10)
+    np.testing.assert_array_equal(slab['pbc'], reference.pbc)
+
+
+@pytest.mark.parametrize('surface', surface_selections)
+def test_chunked_positions(surface):
+    lattice = slab_lattice.SlabLattice(surface, 'Au', 4.08, (3, 2, 4), 10.0)
+    full = np.concatenate(list(lattice.iter_positions()))
+    chunked = np.concatenate(list(lattice.iter_positions(chunk_layers=1)))
+    np.testing.assert_array_equal(full, chunked)
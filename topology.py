@@ -0,0 +1,74 @@
+"""
+Bond connectivity for Nanocars.
+Builds a CSR-style adjacency index (offsets + neighbors) from the flat cjson bond list.
+"""
+import numpy as np
+
+
+def build_adjacency(connections, n_atoms):
+    """
+    Build adjacency index from flat bond list [i0, j0, i1, j1, ...].
+    Neighbors of atom i are neighbors[offsets[i]:offsets[i + 1]].
+    """
+    bonds = np.asarray(connections, dtype=np.int64).reshape(-1, 2)
+    # Each bond is listed in both directions
+    src = np.concatenate([bonds[:, 0], bonds[:, 1]])
+    dst = np.concatenate([bonds[:, 1], bonds[:, 0]])
+    order = np.argsort(src, kind='stable')
+    offsets = np.zeros(n_atoms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n_atoms), out=offsets[1:])
+    return offsets, dst[order]
+
+
+def degree(offsets, atoms=None):
+    """Number of bonded neighbors for given atoms (all atoms by default)."""
+    deg = np.diff(offsets)
+    return deg if atoms is None else deg[atoms]
+
+
+def neighbor_mean(offsets, neighbors, coords, atoms):
+    """Mean coordinates of bonded neighbors for each of the given atoms."""
+    atoms = np.asarray(atoms, dtype=np.int64)
+    deg = degree(offsets, atoms)
+    # Gather neighbor indices of all requested atoms in one pass
+    starts = np.repeat(offsets[atoms] - np.cumsum(deg) + deg, deg)
+    idx = neighbors[starts + np.arange(deg.sum())]
+    sums = np.zeros((len(atoms), 3))
+    np.add.at(sums, np.repeat(np.arange(len(atoms)), deg), coords[idx])
+    return sums / np.maximum(deg, 1)[:, None]
+
+
+def angles(offsets, neighbors):
+    """
+    All angles i-j-k (j is the center atom) as an (n_angles, 3) array.
+    Centers are grouped by their number of neighbors so that pairs of neighbors are
+    enumerated with one index array per degree instead of a loop over atoms.
+    """
+    deg = degree(offsets)
+    result = [np.zeros((0, 3), dtype=np.int64)]
+    for d in np.unique(deg[deg > 1]):
+        centers = np.where(deg == d)[0]
+        a, b = np.triu_indices(d, k=1)
+        nbrs = neighbors[offsets[centers][:, None] + np.arange(d)]
+        result.append(np.stack([nbrs[:, a], np.repeat(centers[:, None], len(a), axis=1), nbrs[:, b]],
+                               axis=2).reshape(-1, 3))
+    return np.concatenate(result)
+
+
+def dihedrals(offsets, neighbors, bonds):
+    """
+    All proper dihedrals i-j-k-l around the given bonds (j-k) as an (n_dihedrals, 4) array.
+    Every neighbor of j is combined with every neighbor of k at once, excluding the bond
+    atoms themselves and three membered rings (i == l).
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    j, k = bonds[:, 0], bonds[:, 1]
+    dj, dk = degree(offsets, j), degree(offsets, k)
+    counts = dj * dk
+    # Position of each combination within its bond: neighbor a of j and neighbor c of k
+    idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    a, c = idx // np.repeat(dk, counts), idx % np.repeat(dk, counts)
+    j, k = np.repeat(j, counts), np.repeat(k, counts)
+    i, l = neighbors[offsets[j] + a], neighbors[offsets[k] + c]
+    keep = (i != k) & (l != j) & (i != l)
+    return np.column_stack([i[keep], j[keep], k[keep], l[keep]])
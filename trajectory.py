@@ -0,0 +1,370 @@
+"""
+Nanocar trajectory analysis.
+Reads the LAMMPS custom dump written by the simulation (traj.xyz, or traj.bin for binary dumps)
+frame by frame through a memory map, so trajectories larger than memory can be analyzed, and parses the thermo blocks
+of log.nanocar. Per frame the center of mass of each nanocar (molecule id), its chassis and
+the orientation of each wheel are computed, from which the mean squared displacement (FFT),
+diffusion coefficients, wheel rotation angles and chassis drift are obtained.
+Wheel rotations are measured about the wheel axle, taken from the wheel library (alignment vector)
+for wheels that are known by name (scene.json).
+Frames can be split over a process pool.
+
+Usage:
+ >>> python trajectory.py traj.xyz --wheels 65-124 125-184 --timestep 1.0 --processes 4
+"""
+import os
+import mmap
+import json
+import argparse
+import numpy as np
+from binary_dump import BinaryDump
+
+
+FRAME_START = b'ITEM: TIMESTEP'
+POSITION_COLUMNS = ['xu', 'yu', 'zu']
+WHEEL_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'wheel')
+
+
+def frame_offsets(traj_file):
+    """Byte offsets of each frame in the dump file (with the file size as the last offset)."""
+    offsets = []
+    with open(traj_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.find(FRAME_START)
+        while pos >= 0:
+            offsets.append(pos)
+            pos = mm.find(FRAME_START, pos + len(FRAME_START))
+        offsets.append(len(mm))
+    return np.array(offsets, dtype=np.int64)
+
+
+def parse_frame(frame):
+    """Parse a single dump frame (bytes) to timestep, box bounds and a dict of atom columns."""
+    lines = frame.split(b'\n', 9)
+    timestep = int(lines[1])
+    n_atoms = int(lines[3])
+    box = np.array([line.split()[:2] for line in lines[5:8]], dtype=float)
+    columns = lines[8].split()[2:]
+    values = np.array(lines[9].split()[:n_atoms * len(columns)]).reshape(n_atoms, len(columns))
+    data = {}
+    for idx, name in enumerate(columns):
+        name = name.decode()
+        data[name] = values[:, idx].astype(str) if name == 'element' else values[:, idx].astype(float)
+    return timestep, box, data
+
+
+def iter_frames(traj_file, start=0, stop=None, offsets=None):
+    """
+    Yield (timestep, box, atom columns) for frames start to stop, reading one frame at a time.
+    Columns of binary dumps are views into the memory mapped file, valid until the next frame is read.
+    """
+    if is_binary(traj_file):
+        with BinaryDump(traj_file) as dump:
+            stop = len(dump) if stop is None else min(stop, len(dump))
+            for idx in range(start, stop):
+                yield dump.columns(idx)
+        return
+    offsets = frame_offsets(traj_file) if offsets is None else offsets
+    stop = len(offsets) - 1 if stop is None else min(stop, len(offsets) - 1)
+    with open(traj_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for idx in range(start, stop):
+            yield parse_frame(mm[offsets[idx]:offsets[idx + 1]])
+
+
+def count_frames(traj_file):
+    """Number of frames in a dump file."""
+    if is_binary(traj_file):
+        with BinaryDump(traj_file) as dump:
+            return len(dump)
+    return len(frame_offsets(traj_file)) - 1
+
+
+def is_binary(traj_file):
+    """LAMMPS writes binary dumps for file names ending with .bin."""
+    return traj_file.endswith('.bin')
+
+
+def read_masses(data_file):
+    """Atom masses indexed by atom type from the Masses section of a LAMMPS data file."""
+    masses = {}
+    with open(data_file, 'r') as f:
+        for line in f:
+            if line.strip() == 'Masses':
+                break
+        next(f, None)
+        for line in f:
+            words = line.split('#')[0].split()
+            if not words:
+                break
+            masses[int(words[0])] = float(words[1])
+    table = np.full(max(masses, default=0) + 1, np.nan)
+    table[list(masses)] = list(masses.values())
+    return table
+
+
+def read_wheels(scene_file):
+    """Atom ids of each wheel in a scene file (scene.json written with the LAMMPS files)."""
+    from scene_state import read_scene_file
+    scene = read_scene_file(scene_file)
+    if scene is None:
+        return []
+    return [list(range(c['id'][0], c['id'][1] + 1)) for c in scene['components'] if c['kind'] == 'wheel']
+
+
+def read_wheel_names(scene_file):
+    """Library name of each wheel in a scene file (same order as read_wheels)."""
+    from scene_state import read_scene_file
+    scene = read_scene_file(scene_file)
+    if scene is None:
+        return []
+    return [c.get('name') for c in scene['components'] if c['kind'] == 'wheel']
+
+
+def wheel_axles(names, reference, wheel_dir=WHEEL_DIR):
+    """
+    Axle direction of each wheel in the reference (first frame) coordinates, from the alignment vector of the
+    wheel in the library rotated onto the reference (kabsch). NaN for wheels that are not in the library,
+    have no alignment site or whose number of atoms differs from the library wheel.
+    """
+    from molecule_library import load_library, get_molecule
+    library = load_library(wheel_dir) if os.path.isdir(wheel_dir) else None
+    axles = np.full((len(reference), 3), np.nan)
+    for k, (name, ref) in enumerate(zip(names, reference)):
+        if library is None or name not in library['names']:
+            continue
+        entry = get_molecule(library, name)
+        atoms = entry['coordinates'][entry['numbers'] > 0]
+        if len(atoms) != len(ref) or not np.linalg.norm(entry['alignment_vector']) > 0:
+            continue
+        axles[k] = kabsch(atoms - atoms.mean(axis=0), ref) @ entry['alignment_vector']
+    return axles
+
+
+def read_log(log_file):
+    """
+    Thermo data from a LAMMPS log file as a dict of arrays (all thermo blocks concatenated).
+    Blocks start with the thermo header (Step ...) and end with the 'Loop time' line.
+    """
+    columns, rows = None, []
+    with open(log_file, 'r') as f:
+        block = None
+        for line in f:
+            words = line.split()
+            if words and words[0] == 'Step':
+                block, columns = [], words if columns is None else columns
+            elif block is not None:
+                if line.startswith('Loop time') or not words:
+                    # Consecutive runs repeat the last step of the previous run
+                    if block and rows and block[0][0] == rows[-1][0]:
+                        block = block[1:]
+                    rows.extend(block)
+                    block = None
+                else:
+                    try:
+                        block.append([float(i) for i in words])
+                    except ValueError:
+                        # Warnings printed inside a thermo block
+                        continue
+        if block is not None:
+            # Unfinished run
+            rows.extend(block)
+    if columns is None:
+        return {}
+    rows = np.array([row for row in rows if len(row) == len(columns)]).reshape(-1, len(columns))
+    return {name: rows[:, idx] for idx, name in enumerate(columns)}
+
+
+def frame_properties(traj_file, start, stop, wheels, reference, offsets=None, masses=None):
+    """
+    Per frame properties for frames start to stop:
+    timesteps, nanocar centers of mass, chassis centers of mass, wheel centers and wheel orientations
+    (rotation matrices relative to the wheel reference coordinates).
+    Wheels are lists of atom ids, reference holds the centered wheel coordinates in the first frame.
+    Masses are taken from the element column or, for dumps with atom types only, from masses (indexed by type).
+    """
+    from elements import masses as element_masses, atomic_numbers
+    timesteps, mol_com, chassis_com, wheel_com, wheel_rot = [], [], [], [], []
+    for timestep, _, data in iter_frames(traj_file, start, stop, offsets):
+        order = np.argsort(data['id'])
+        ids = data['id'][order].astype(np.int64)
+        coords = np.column_stack([data[c][order] for c in POSITION_COLUMNS])
+        if not timesteps:
+            if 'element' in data:
+                atom_masses = element_masses(atomic_numbers(data['element'][order]))
+            else:
+                atom_masses = masses[data['type'][order].astype(np.int64)]
+            mols = data['mol'][order].astype(np.int64) if 'mol' in data else np.ones(len(ids), dtype=np.int64)
+            mol_list = np.unique(mols)
+            mol_index = np.searchsorted(mol_list, mols)
+            wheel_idx = [np.searchsorted(ids, w) for w in wheels]
+            chassis = np.ones(len(ids), dtype=bool)
+            for w in wheel_idx:
+                chassis[w] = False
+        timesteps.append(timestep)
+        mol_com.append(_group_com(coords, atom_masses, mol_index, len(mol_list)))
+        chassis_com.append(_group_com(coords[chassis], atom_masses[chassis], mol_index[chassis], len(mol_list)))
+        centers = np.array([coords[w].mean(axis=0) for w in wheel_idx]).reshape(-1, 3)
+        wheel_com.append(centers)
+        wheel_rot.append(np.array([kabsch(ref, coords[w] - c) for w, ref, c in zip(wheel_idx, reference, centers)])
+                         .reshape(-1, 3, 3))
+    return (np.array(timesteps), np.array(mol_com).reshape(-1, len(mol_list), 3),
+            np.array(chassis_com).reshape(-1, len(mol_list), 3), np.array(wheel_com).reshape(-1, len(wheels), 3),
+            np.array(wheel_rot).reshape(-1, len(wheels), 3, 3), mol_list, mol_index)
+
+
+def analyze(traj_file, wheels=(), timestep=1.0, processes=None, dims=2, data_file=None, wheel_names=None):
+    """
+    Analyze a nanocar trajectory.
+    Wheels are lists of atom ids (as in the data file) for each wheel. Wheel rotations are measured about
+    the axle of the library wheel given in wheel_names (see wheel_axles), or about the line from the chassis
+    center to the wheel center for wheels without a library name. Timestep is the simulation
+    timestep in fs, dims the number of dimensions (x, y, z) used for MSD and diffusion (2: surface plane).
+    Returns a dict of numpy arrays: time (ps), nanocar COM, MSD (Å²) per nanocar, diffusion coefficients
+    (Å²/ps), chassis drift (Å) and cumulative wheel rotation angles (degrees).
+    Atom masses for dumps without an element column (binary dumps) are read from the data file
+    (data.nanocar next to the dump by default).
+    """
+    offsets = None if is_binary(traj_file) else frame_offsets(traj_file)
+    n_frames = count_frames(traj_file) if offsets is None else len(offsets) - 1
+    wheels = [np.asarray(w, dtype=np.int64) for w in wheels]
+    # Wheel reference coordinates from the first frame
+    _, _, data = next(iter_frames(traj_file, 0, 1, offsets))
+    order = np.argsort(data['id'])
+    ids, coords = data['id'][order], np.column_stack([data[c][order] for c in POSITION_COLUMNS])
+    reference = [coords[np.searchsorted(ids, w)] - coords[np.searchsorted(ids, w)].mean(axis=0) for w in wheels]
+    masses = None
+    if 'element' not in data:
+        if data_file is None:
+            data_file = os.path.join(os.path.dirname(os.path.abspath(traj_file)), 'data.nanocar')
+        masses = read_masses(data_file)
+
+    if processes is not None and processes > 1 and n_frames > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        bounds = np.linspace(0, n_frames, min(processes, n_frames) + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parts = list(pool.map(frame_properties, *zip(*[(traj_file, a, b, wheels, reference, offsets, masses)
+                                                           for a, b in zip(bounds[:-1], bounds[1:])])))
+        results = [np.concatenate([p[i] for p in parts]) for i in range(5)]
+        mol_list, mol_index = parts[0][5], parts[0][6]
+    else:
+        *results, mol_list, mol_index = frame_properties(traj_file, 0, n_frames, wheels, reference, offsets,
+                                                                  masses)
+    timesteps, mol_com, chassis_com, wheel_com, wheel_rot = results
+
+    time = (timesteps - timesteps[0]) * timestep / 1000
+    msd = msd_fft(mol_com[:, :, :dims])
+    result = {'time': time, 'timesteps': timesteps, 'molecules': mol_list, 'com': mol_com, 'msd': msd,
+              'diffusion': diffusion_coefficient(msd, time, dims),
+              'drift': chassis_com - chassis_com[0]}
+    if wheels:
+        # Wheels are assigned to the nanocar (molecule) of their first atom
+        ids_sorted = ids.astype(np.int64)
+        wheel_mols = np.array([mol_index[np.searchsorted(ids_sorted, w[0])] for w in wheels])
+        axles = wheel_com - chassis_com[:, wheel_mols]
+        if wheel_names is not None:
+            # Library axles follow the wheel rotation from the first frame
+            axle0 = wheel_axles(wheel_names, reference)
+            known = ~np.isnan(axle0).any(axis=1)
+            axles[:, known] = np.einsum('fwij,wj->fwi', wheel_rot[:, known], axle0[known])
+        result['wheel_rotation'] = rotation_angles(wheel_rot, axles)
+    return result
+
+
+def msd_fft(positions):
+    """
+    Mean squared displacement for all lag times with FFT based correlation (O(N log N)).
+    Positions have shape (n_frames, ...) with the last axis the dimensions, MSD has shape (n_frames, ...).
+    """
+    x = np.asarray(positions, dtype=float)
+    n = len(x)
+    if n == 0:
+        return np.zeros(x.shape[:-1])
+    # S2: position autocorrelation summed over dimensions
+    f = np.fft.rfft(x, n=2 * n, axis=0)
+    s2 = np.fft.irfft(f * f.conj(), axis=0)[:n].sum(axis=-1)
+    s2 /= (n - np.arange(n)).reshape((-1,) + (1,) * (s2.ndim - 1))
+    # S1: recursive sum of squares
+    d = (x ** 2).sum(axis=-1)
+    d = np.concatenate([d, np.zeros((1,) + d.shape[1:])])
+    q = 2 * d[:n].sum(axis=0)
+    s1 = np.zeros_like(s2)
+    for m in range(n):
+        q = q - d[m - 1] - d[n - m]
+        s1[m] = q / (n - m)
+    return s1 - 2 * s2
+
+
+def diffusion_coefficient(msd, time, dims=2, fit=(0.1, 0.5)):
+    """Diffusion coefficient from a linear fit of MSD between fractions fit of the trajectory: MSD = 2 d D t."""
+    n = len(time)
+    start, end = int(fit[0] * n), max(int(fit[1] * n), int(fit[0] * n) + 2)
+    if end > n:
+        return np.full(msd.shape[1:], np.nan)
+    t = time[start:end]
+    slope = np.polyfit(t, msd[start:end].reshape(len(t), -1), 1)[0]
+    return slope.reshape(msd.shape[1:]) / (2 * dims)
+
+
+def rotation_angles(rotations, axles):
+    """
+    Cumulative rotation angle (degrees) of each wheel about its axle.
+    Frame to frame rotations are converted to rotation vectors and projected onto the axle direction.
+    """
+    steps = np.einsum('fwij,fwkj->fwik', rotations[1:], rotations[:-1])
+    # Rotation vector from the antisymmetric part, angle from the trace
+    cos = np.clip((np.trace(steps, axis1=2, axis2=3) - 1) / 2, -1, 1)
+    angle = np.arccos(cos)
+    axis = np.stack([steps[..., 2, 1] - steps[..., 1, 2], steps[..., 0, 2] - steps[..., 2, 0],
+                     steps[..., 1, 0] - steps[..., 0, 1]], axis=-1)
+    norm = np.linalg.norm(axis, axis=-1)
+    axis = np.divide(axis, norm[..., None], out=np.zeros_like(axis), where=norm[..., None] > 1e-12)
+    axle = axles[1:] / np.linalg.norm(axles[1:], axis=-1)[..., None]
+    projected = angle * np.einsum('fwi,fwi->fw', axis, axle)
+    return np.degrees(np.concatenate([np.zeros((1, rotations.shape[1])), np.cumsum(projected, axis=0)]))
+
+
+def kabsch(reference, coords):
+    """Rotation matrix that best maps centered reference coordinates onto centered coordinates."""
+    u, _, vt = np.linalg.svd(coords.T @ reference)
+    d = np.sign(np.linalg.det(u @ vt))
+    return u @ np.diag([1, 1, d]) @ vt
+
+
+def _group_com(coords, masses, groups, n_groups):
+    weights = np.bincount(groups, masses, minlength=n_groups)
+    com = np.column_stack([np.bincount(groups, masses * coords[:, i], minlength=n_groups) for i in range(3)])
+    return com / weights[:, None]
+
+
+def _id_range(text):
+    start, _, end = text.partition('-')
+    return list(range(int(start), int(end or start) + 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze nanocar trajectory.')
+    parser.add_argument('traj', type=str, help='LAMMPS dump file (traj.xyz or traj.bin).')
+    parser.add_argument('--wheels', nargs='*', default=None,
+                        help='Atom id range for each wheel (e.g. 65-124), default: wheels in scene.json.')
+    parser.add_argument('--timestep', type=float, default=1.0, help='Simulation timestep in fs.')
+    parser.add_argument('--data', type=str, default=None,
+                        help='LAMMPS data file with atom masses for binary dumps (default: data.nanocar).')
+    parser.add_argument('--processes', '-p', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Save results to npz file.')
+    args = vars(parser.parse_args())
+
+    wheel_names = None
+    if args['wheels'] is None:
+        scene_file = os.path.join(os.path.dirname(os.path.abspath(args['traj'])), 'scene.json')
+        wheels, wheel_names = read_wheels(scene_file), read_wheel_names(scene_file)
+    else:
+        wheels = [_id_range(w) for w in args['wheels']]
+    result = analyze(args['traj'], wheels, args['timestep'], args['processes'],
+                     data_file=args['data'], wheel_names=wheel_names)
+    summary = {'frames': len(result['time']), 'time (ps)': float(result['time'][-1]),
+               'diffusion (A2/ps)': result['diffusion'].tolist(),
+               'drift (A)': np.linalg.norm(result['drift'][-1], axis=-1).tolist()}
+    if 'wheel_rotation' in result:
+        summary['wheel rotation (deg)'] = result['wheel_rotation'][-1].tolist()
+    print(json.dumps(summary, indent=2))
+    if args['output'] is not None:
+        np.savez(args['output'], **result)